@@ -0,0 +1,166 @@
+"""
+Checks that DataHandler._clean_kernel gives the same results as the per-column flags/_cutoffs
+implementation it replaced, and compares the speed and peak memory of both. Run from the root of
+the repository:
+
+        $ python3 -m data_analysis.bench_cleaning
+
+The old flags made three full copies of the dataframe for every data column (two assigns and a
+drop), plus masked .loc writes; the old _cutoffs made up to two more .loc writes per column. The
+kernel copies the data columns once into a NumPy block and writes them back with a single assign.
+CopyCounter counts these copying operations for both implementations. The equivalence of the two
+is asserted by tests/test_cleaning.py.
+
+Project: Air Partners
+"""
+import time
+import functools
+import tracemalloc
+from collections import Counter
+import numpy as np
+import pandas as pd
+from pandas.core.indexing import _LocIndexer
+from data_analysis.quantaq_pipeline import ModPMHandler, SNHandler, CUTOFF
+
+
+def legacy_flags(handler, df):
+    """flags as it was before the cleaning kernel, kept as the reference implementation"""
+    sub_df = df[handler.data_cols]
+    stdev = sub_df.std(axis=0, skipna=True)
+    for c in handler.data_cols:
+        df = df.assign(prev=df[c].shift(-1))
+        df = df.assign(next=df[c].shift(1))
+        threshold = df[c] - (stdev[c] * 3)
+        df.loc[(df.prev <= threshold) & (df.next <= threshold), c] = np.nan
+        df = df.drop(columns=['next', 'prev'])
+    return df
+
+
+def legacy_cutoffs(handler, df, cols=None, smoothed=True):
+    """_cutoffs as it was before the cleaning kernel, kept as the reference implementation"""
+    if not cols:
+        cols = handler.data_cols
+    for c in cols:
+        if not df[c].isnull().all():
+            df.loc[df[c] < 0, c] = np.nan
+            if smoothed:
+                df.loc[df[c] > CUTOFF, c] = 0
+    return df
+
+
+class CopyCounter(object):
+    """
+    Counts the dataframe operations that copy data while it is active: whole-frame assign, drop and copy, selecting
+    a list of columns, to_numpy and masked .loc writes. Only the outermost operation is counted, so an assign that
+    copies the frame internally counts once.
+
+        with CopyCounter() as copies:
+            handler.flags(df)
+        print(copies.total, dict(copies.counts))
+    """
+    OPERATIONS = [
+        (pd.DataFrame, "assign", None),
+        (pd.DataFrame, "drop", None),
+        (pd.DataFrame, "copy", None),
+        (pd.DataFrame, "to_numpy", None),
+        #selecting a single column is a view, a list of columns is a copy
+        (pd.DataFrame, "__getitem__", lambda key: isinstance(key, list)),
+        (_LocIndexer, "__setitem__", None),
+    ]
+
+    def __init__(self):
+        self.counts = Counter()
+        self._depth = 0
+        self._originals = []
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def _wrap(self, name, method, counts_key):
+        @functools.wraps(method)
+        def counted(obj, *args, **kwargs):
+            if self._depth == 0 and (counts_key is None or counts_key(args[0])):
+                self.counts[name] += 1
+            self._depth += 1
+            try:
+                return method(obj, *args, **kwargs)
+            finally:
+                self._depth -= 1
+        return counted
+
+    def __enter__(self):
+        for cls, attr, counts_key in self.OPERATIONS:
+            method = getattr(cls, attr)
+            self._originals.append((cls, attr, method))
+            name = ".loc[]=" if cls is _LocIndexer else attr
+            setattr(cls, attr, self._wrap(name, method, counts_key))
+        return self
+
+    def __exit__(self, *exc):
+        for cls, attr, method in reversed(self._originals):
+            setattr(cls, attr, method)
+        self._originals = []
+
+
+def make_month(cols, n=43200, seed=0):
+    """a month of minute data with spikes, negative values, values over the cutoff, NaNs and an empty column"""
+    rng = np.random.default_rng(seed)
+    data = {c: rng.gamma(2.0, 5.0, n) for c in cols}
+    for c in cols:
+        idx = rng.choice(n, n // 200, replace=False)
+        data[c][idx] += rng.uniform(50, 500, idx.size)
+        data[c][rng.choice(n, n // 500, replace=False)] *= -1
+        data[c][rng.choice(n, n // 100, replace=False)] = np.nan
+    data[cols[-1]][:] = np.nan
+    df = pd.DataFrame(data)
+    df.insert(0, 'timestamp', pd.date_range('2022-06-01', periods=n, freq='1min', tz='UTC'))
+    return df
+
+
+def measure(func, *args):
+    """run func once, returning its result, the time it took and its peak allocated memory"""
+    tracemalloc.start()
+    s = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - s
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def count_copies(func, *args):
+    """run func once, returning the CopyCounter of the copying operations it did"""
+    with CopyCounter() as copies:
+        func(*args)
+    return copies
+
+
+def compare(name, legacy, kernel, df):
+    expected, legacy_s, legacy_peak = measure(legacy, df.copy())
+    result, kernel_s, kernel_peak = measure(kernel, df.copy())
+    pd.testing.assert_frame_equal(result, expected)
+    legacy_copies = count_copies(legacy, df.copy())
+    kernel_copies = count_copies(kernel, df.copy())
+    print(f"{name}: identical output. legacy {legacy_s:.3f}s / {legacy_peak / 2**20:.1f} MiB peak, "
+          f"kernel {kernel_s:.3f}s / {kernel_peak / 2**20:.1f} MiB peak")
+    print(f"    copying operations: legacy {legacy_copies.total} {dict(legacy_copies.counts)}, "
+          f"kernel {kernel_copies.total} {dict(kernel_copies.counts)}")
+
+
+if __name__ == '__main__':
+    for smoothed in [True, False]:
+        # MOD-PM order: spikes first, then cutoffs
+        mod = ModPMHandler()
+        compare(f"MOD-PM (smoothed={smoothed})",
+                lambda df: legacy_cutoffs(mod, legacy_flags(mod, df), smoothed=smoothed),
+                lambda df: mod._clean_kernel(df, smoothed=smoothed),
+                make_month(mod.data_cols))
+
+        # SN order: cutoffs on a subset of columns first, then spikes on all of them
+        sn = SNHandler()
+        subset = ["o3", "co", "no2", "bin0", "pm1", "no"]
+        compare(f"SN (smoothed={smoothed})",
+                lambda df: legacy_flags(sn, legacy_cutoffs(sn, df, cols=subset, smoothed=smoothed)),
+                lambda df: sn.flags(sn._cutoffs(df, cols=subset, smoothed=smoothed)),
+                make_month(sn.data_cols))
@@ -0,0 +1,118 @@
+"""
+Project: Air Partners
+Description: Bulk import of historical QuantAQ csv exports into the cleaned data store
+
+QuantAQ exports are usually one csv per sensor and day, for the final and the raw data separately. bulk_import reads
+them in parallel with the pyarrow csv engine, only reading the columns the handler needs, and stores one cleaned
+dataframe per month, like the monthly pipeline does. Only the month being imported (plus one batch of files) is in
+memory at a time, so years of exports can be imported at once.
+
+Example:
+    python3 -m data_analysis.bulk_import MOD-PM-00217 "exports/MOD-PM-00217/final/*.csv" exports/MOD-PM-00217/raw
+"""
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from data_analysis.quantaq_pipeline import SNHandler, ModPMHandler
+
+# csv engine used to read the exports, pyarrow parses in native threads and is several times faster than the default
+CSV_ENGINE = "pyarrow"
+# number of files read at the same time
+READ_WORKERS = 4
+# columns that are read as text, every other column is read as a float
+TEXT_COLS = ["timestamp", "timestamp_local", "sn", "model", "pm1_model_id", "pm25_model_id", "pm10_model_id"]
+
+
+def expand_paths(source):
+    """
+    :param source: (str) a folder, a glob pattern or a single csv file
+    :returns: sorted list of csv paths. Exports are named by date, so sorting by name sorts them in time
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, "*.csv")
+    return sorted(glob.glob(source))
+
+
+def read_export(path, columns):
+    """
+    Read the needed columns of one csv export, with explicit dtypes.
+
+    :param path: (str) path to the csv file
+    :param columns: (list of str) columns to read, columns missing from the file are skipped
+    :returns: pd.DataFrame with timestamps parsed as UTC
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in columns if c in header]
+    dtypes = {c: "string" if c in TEXT_COLS else "float64" for c in usecols}
+    df = pd.read_csv(path, engine=CSV_ENGINE, usecols=usecols, dtype=dtypes)
+    return df.assign(timestamp=pd.to_datetime(df["timestamp"], utc=True))
+
+
+def iter_months(paths, columns, max_workers=READ_WORKERS):
+    """
+    Read csv exports in batches of max_workers files at a time and group their rows by month. A month is
+    yielded as soon as a batch only contains later months, so the files must be sorted in time.
+
+    :param paths: (list of str) sorted csv paths
+    :param columns: (list of str) columns to read
+    :param max_workers: (optional int) number of files read at the same time
+    :returns: generator of (pd.Period, pd.DataFrame) tuples, in time order
+    """
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i in range(0, len(paths), max_workers):
+            batch_months = []
+            for df in pool.map(lambda path: read_export(path, columns), paths[i:i + max_workers]):
+                months = df["timestamp"].dt.tz_localize(None).dt.to_period("M")
+                for month, rows in df.groupby(months, sort=False):
+                    pending.setdefault(month, []).append(rows)
+                    batch_months.append(month)
+            #months before the earliest month in this batch won't get any more rows
+            done = [m for m in sorted(pending) if batch_months and m < min(batch_months)]
+            for month in done:
+                yield month, pd.concat(pending.pop(month), ignore_index=True)
+    for month in sorted(pending):
+        yield month, pd.concat(pending.pop(month), ignore_index=True)
+
+
+def bulk_import(sensor_id, final_source, raw_source, smoothed=True, max_workers=READ_WORKERS):
+    """
+    Clean and store csv exports of a sensor, one month at a time. Each month is stored under the same name as the
+    monthly pipeline would store it, so reports can be made from imported months without downloading them.
+
+    :param sensor_id: (str) unique ID of the QuantAQ sensor that the exports came from
+    :param final_source: (str) folder, glob pattern or file of the final data exports
+    :param raw_source: (str) folder, glob pattern or file of the raw data exports
+    :param smoothed: (optional bool) True if unrealistically large values should be removed
+    :param max_workers: (optional int) number of files read at the same time
+    :returns: dictionary of month strings and the number of rows stored for that month
+    """
+    handler_cls = ModPMHandler if sensor_id.startswith("MOD-PM") else SNHandler
+    final_cols, raw_cols = handler_cls().csv_cols
+
+    summary = {}
+    raw_months = iter_months(expand_paths(raw_source), raw_cols, max_workers)
+    raw_month, df_raw = next(raw_months, (None, None))
+    for month, df_fin in iter_months(expand_paths(final_source), final_cols, max_workers):
+        #skip raw months without final data
+        while raw_month is not None and raw_month < month:
+            raw_month, df_raw = next(raw_months, (None, None))
+        if raw_month != month:
+            print(f"{sensor_id}: no raw data for {month}, skipping")
+            continue
+
+        start = month.start_time.to_pydatetime()
+        end = (month + 1).start_time.to_pydatetime()
+        df = handler_cls(start_date=start, end_date=end).from_frames(sensor_id, df_fin, df_raw, smoothed=smoothed,
+                                                                     local=False)
+        summary[str(month)] = len(df)
+        print(f"{sensor_id}: stored {len(df)} rows for {month}", flush=True)
+    return summary
+
+
+if __name__ == "__main__":
+    # python3 -m data_analysis.bulk_import <sensor_id> <final folder or glob> <raw folder or glob>
+    import sys
+    bulk_import(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -18,7 +18,7 @@ start, end = datetime(2021, 3, 1), datetime(2021, 3, 10)
 #define a sensor ID to pull data from
 #initialize appropriate handler
 sn_handler = qp.SNHandler(start_date=start, end_date=end)
-#can pull dataframe from API, will return the dataframe and will also pickle the results for you to open and use later
+#can pull dataframe from API, will return the dataframe and will also store the results for you to open and use later
 #SMOOTHING: If a dataset is smoothed out in this context, then sensor measurements that are unrealistically high are filtered
 #     out of the dataset. typically you want data smoothed to analyze trends, but you can set smoothed=False to see the 
 #     "full picture". note that some granularity is lost by setting smoothed=True.
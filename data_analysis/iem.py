@@ -11,17 +11,38 @@ Code to automatically pull meteorology data from IEM website based on following
     * represent missing data with blank string
     * denote trace with blank string
 Specifications based on https://github.com/scott-hersey/EB_AQ_Network/blob/master/initial_analysis_walkthrough.Rmd
+
+Downloaded data is cached per station and UTC day, both in memory for the current run and on disk in CACHE_DIR,
+so a month of weather data is only requested from IEM once no matter how many sensors use it.
 """
+import os
+import math
 import json
-import time
+import random
+import asyncio
 import datetime
+import threading
+from pathlib import Path
+import aiohttp
+import numpy as np
 import pandas as pd
-from urllib import parse, request
+from urllib import parse
 from io import StringIO
+from data_analysis.replay import iem_fixture_path
 
 # Number of attempts to download data
 MAX_ATTEMPTS = 6
-SERVICE = "http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?"
+# IEM throttles bursts of requests, so at most this many are sent at the same time
+MAX_CONCURRENT_REQUESTS = 3
+# seconds to wait after the first failed attempt; the wait doubles (up to BACKOFF_MAX) with every failed attempt
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+# seconds before a single request is abandoned
+TIMEOUT = 300
+# can be pointed at a local data_analysis.replay.ReplayServer to run without the real IEM service
+SERVICE = os.environ.get("IEM_SERVICE", "http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?")
+# if set, every downloaded response is also saved as a replay fixture in this folder
+RECORD_DIR = os.environ.get("IEM_RECORD_DIR")
 
 # based on specifications these should not change unless we decide to change sensor networks
 DEFAULT_PARAMS = {
@@ -36,10 +57,132 @@ DEFAULT_PARAMS = {
     "direct": "no",     # i'm not sure what this means, it is included when downloading from webpage
     "report_type": 1    #IEM encoded code for the report type
 }
+# ASOS stations around Boston and their locations. Every sensor uses the station closest to it, unless a station
+# is configured for it in STATION_OVERRIDES_PATH
+STATIONS = {
+    "BOS": {"name": "Boston Logan", "lat": 42.3606, "lon": -71.0097},
+    "OWD": {"name": "Norwood", "lat": 42.1905, "lon": -71.1729},
+    "BED": {"name": "Bedford Hanscom", "lat": 42.4700, "lon": -71.2890},
+    "BVY": {"name": "Beverly", "lat": 42.5842, "lon": -70.9164},
+    "LWM": {"name": "Lawrence", "lat": 42.7172, "lon": -71.1234},
+    "PYM": {"name": "Plymouth", "lat": 41.9097, "lon": -70.7294},
+    "ORH": {"name": "Worcester", "lat": 42.2673, "lon": -71.8757},
+}
+# json file mapping sensor serial numbers to the station they should use, e.g. {"MOD-PM-00217": "BOS"}
+STATION_OVERRIDES_PATH = "iem_stations.json"
 # IEM query string pattern adds new key, value pair for each data column requested, i.e. 2 data cols = data=sped&data=drct...
 # python cannot have more than 1 identical key in a dictionary, so we have these hardcoded. Same issue for report_type, unfortunately
 ADDTL_PARAMS_STR = "&data=sped&report_type=2"
 
+# folder where downloaded data is stored, one csv per station per UTC day
+CACHE_DIR = "iem_cache"
+# IEM keeps adding late reports for a while after a day is over, so only days at least this old are stored
+SETTLE_DAYS = 1
+# columns returned by IEM for the request above, used for days without any data
+COLUMNS = ["station", "valid", "drct", "sped"]
+# counts days served from the cache (hits), days that had to be downloaded (misses) and requests sent to IEM
+CACHE_STATS = {"hits": 0, "misses": 0, "requests": 0}
+# sensor readings further than this from an IEM report get no weather data (reports are ~5 minutes apart)
+JOIN_TOLERANCE = pd.Timedelta(hours=1)
+# converts IEM wind speed to m/s, 1609 meters per mile, 3600 seconds per hr
+MPH_TO_MS = 1609 / 3600
+# in-memory copy of the cache for this run, keyed by (station, day)
+_cache = {}
+# protects _cache and _in_flight; sensors may be downloaded from several threads
+_cache_lock = threading.Lock()
+# days being downloaded right now, keyed by (station, day); the event is set when the download is done, so other
+# threads wait for it instead of downloading the same day again
+_in_flight = {}
+# every IEM request of the process runs on one background event loop, see _event_loop
+_loop = None
+_loop_lock = threading.Lock()
+# limits the requests sent to IEM at the same time, created on the background loop
+_semaphore = None
+
+def _event_loop():
+    """
+    Get the event loop all IEM requests run on, starting it in a daemon thread the first time. Running every request
+    on one loop lets a single semaphore limit them, and works the same whether or not the caller is itself running
+    an event loop (e.g. in Jupyter).
+
+    :returns: asyncio event loop running in a background thread
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="iem-downloads", daemon=True).start()
+        return _loop
+
+def _request_slots():
+    """
+    :returns: (asyncio.Semaphore) the semaphore limiting concurrent requests, must be called on the background loop
+    """
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+async def _download_data_async(session, uri):
+    """
+    Fetch the data from the IEM, retrying with exponential backoff and jitter.
+
+    :param session: (aiohttp.ClientSession) session shared by all requests, so connections are reused
+    :param uri: (str) URL to fetch
+    :returns: string data, or an empty string if every attempt failed
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            async with _request_slots():
+                async with session.get(uri) as response:
+                    response.raise_for_status()
+                    data = await response.text(encoding="utf-8")
+            if data is not None and not data.startswith("ERROR"):
+                return data
+            print("download_data(%s) returned %s" % (uri, data[:80]))
+        except Exception as exp:
+            print("download_data(%s) failed with %s" % (uri, exp))
+        # full jitter keeps retries of concurrent requests from hitting IEM at the same moment
+        if attempt < MAX_ATTEMPTS - 1:
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    print("Exhausted attempts to download, returning empty data")
+    return ""
+
+async def _download_many_async(uris):
+    """
+    Fetch several URLs from the IEM concurrently over one session.
+
+    :param uris: (list of str) URLs to fetch
+    :returns: list of string data, in the same order as uris
+    """
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=TIMEOUT)) as session:
+        return await asyncio.gather(*[_download_data_async(session, uri) for uri in uris])
+
+def download_many(uris):
+    """
+    Fetch several URLs from the IEM concurrently. The IEM download service has some protections in place to keep
+    the number of inbound requests in check, so at most MAX_CONCURRENT_REQUESTS are sent at a time (by all threads
+    together) and failed requests are retried with exponential backoff. Can be called from any thread, including
+    one that is running an event loop.
+
+    :param uris: (list of str) URLs to fetch
+    :returns: list of string data, in the same order as uris. Downloads that failed are empty strings
+    """
+    uris = list(uris)
+    if not uris:
+        return []
+    results = asyncio.run_coroutine_threadsafe(_download_many_async(uris), _event_loop()).result()
+    if RECORD_DIR:
+        for uri, data in zip(uris, results):
+            if data:
+                path = iem_fixture_path(RECORD_DIR, uri)
+                Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+                with open(path, "w") as f:
+                    f.write(data)
+    return results
+
 def download_data(uri):
     """Fetch the data from the IEM
     The IEM download service has some protections in place to keep the number
@@ -50,25 +193,14 @@ def download_data(uri):
     Returns:
       string data
     """
-    attempt = 0
-    while attempt < MAX_ATTEMPTS:
-        try:
-            data = request.urlopen(uri, timeout=300).read().decode("utf-8")
-            if data is not None and not data.startswith("ERROR"):
-                return data
-        except Exception as exp:
-            print("download_data(%s) failed with %s" % (uri, exp))
-            time.sleep(5)
-        attempt += 1
-
-    print("Exhausted attempts to download, returning empty data")
-    return ""
+    return download_many([uri])[0]
 
-def make_request_uri(start, end):
+def make_request_uri(start, end, station=DEFAULT_PARAMS["station"]):
     """
     Builds request URI for meteorology data
     :param start: datetime object for start time of data
     :param end: datetime object for end time of data
+    :param station: (optional str) IEM identifier of the station to request data from
     """
     params = {
         "year1": start.year,
@@ -80,27 +212,276 @@ def make_request_uri(start, end):
     }
     #combine variable parameters with constant parameters into 1 dict
     params.update(DEFAULT_PARAMS)
+    params["station"] = station
 
     #build/return full uri
     return SERVICE + parse.urlencode(params) + ADDTL_PARAMS_STR
 
-def fetch_data(start, end):
+def _day_path(station, day):
+    """
+    Path of the file a day of data from a station is cached in.
+
+    :param station: (str) IEM identifier of the station
+    :param day: (date) UTC day
+    """
+    return os.path.join(CACHE_DIR, station, f"{day.isoformat()}.csv")
+
+def _load_day(station, day):
+    """
+    Get a day of data from the in-memory or on-disk cache.
+
+    :param station: (str) IEM identifier of the station
+    :param day: (date) UTC day
+    :returns: pandas DataFrame with the day's data, or None if the day is not cached
+    """
+    key = (station, day)
+    if key not in _cache and os.path.exists(_day_path(station, day)):
+        _cache[key] = pd.read_csv(_day_path(station, day), sep=",")
+    return _cache.get(key)
+
+def _missing_ranges(days):
+    """
+    Group a sorted list of days into ranges of consecutive days, so each range can be downloaded in one request.
+
+    :param days: (list of date) sorted days
+    :returns: list of (first day, day after last day) tuples
     """
-    Makes a pandas DataFrame from Boston Logan sensor from IEM website.
+    ranges = []
+    for day in days:
+        if ranges and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], day + datetime.timedelta(days=1))
+        else:
+            ranges.append((day, day + datetime.timedelta(days=1)))
+    return ranges
+
+def _store_range(station, first, stop, data):
+    """
+    Split downloaded data for a range of days into per-day files. Days less than SETTLE_DAYS old, and days
+    without any rows (e.g. during an outage), are only kept in memory, since IEM may still add data to them.
+
+    :param station: (str) IEM identifier of the station
+    :param first: (date) first day of the range
+    :param stop: (date) day after the last day of the range
+    :param data: (str) csv data returned by IEM for the range
+    :returns: dictionary of (station, day) keys and the day's data, to be added to the in-memory cache
+    """
+    # nothing is cached if the download failed, so the next call tries again
+    if not data:
+        return {}
+    df = pd.read_csv(StringIO(data), sep=",")
+    row_days = pd.to_datetime(df["valid"]).dt.date
+    settled = datetime.datetime.utcnow().date() - datetime.timedelta(days=SETTLE_DAYS)
+    days = {}
+    day = first
+    while day < stop:
+        day_df = df.loc[row_days == day].reset_index(drop=True)
+        days[(station, day)] = day_df
+        if day < settled and len(day_df):
+            path = _day_path(station, day)
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            day_df.to_csv(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+        day += datetime.timedelta(days=1)
+    return days
+
+def _days(start, end):
+    """
+    Days requested for a time range. Like the IEM request, only the date is used and the last day is not included.
+    """
+    return [start.date() + datetime.timedelta(days=i) for i in range((end.date() - start.date()).days)]
+
+def _fill_cache(station_days):
+    """
+    Download every day that is not cached yet. All missing ranges, of all stations, are downloaded concurrently.
+    The lock is only held to find and reserve the missing days, not during the download, so threads needing other
+    days or stations download at the same time. Days another thread is already downloading are waited for instead
+    of being downloaded again.
+
+    :param station_days: (list of (str, list of date)) stations and the days needed from each
+    """
+    ranges, waits = [], set()
+    with _cache_lock:
+        for station, days in station_days:
+            missing = []
+            for day in days:
+                if (station, day) in _in_flight:
+                    waits.add(_in_flight[(station, day)])
+                elif _load_day(station, day) is None:
+                    missing.append(day)
+            CACHE_STATS["hits"] += len(days) - len(missing)
+            CACHE_STATS["misses"] += len(missing)
+            for first, stop in _missing_ranges(missing):
+                done = threading.Event()
+                day = first
+                while day < stop:
+                    _in_flight[(station, day)] = done
+                    day += datetime.timedelta(days=1)
+                ranges.append((station, first, stop, done))
+        CACHE_STATS["requests"] += len(ranges)
+
+    try:
+        results = download_many(make_request_uri(first, stop, station) for station, first, stop, _ in ranges)
+        downloaded = {}
+        for (station, first, stop, _), data in zip(ranges, results):
+            downloaded.update(_store_range(station, first, stop, data))
+        with _cache_lock:
+            _cache.update(downloaded)
+    finally:
+        # release the reserved days even if the download failed, so waiting threads don't hang
+        with _cache_lock:
+            for station, first, stop, done in ranges:
+                day = first
+                while day < stop:
+                    _in_flight.pop((station, day), None)
+                    day += datetime.timedelta(days=1)
+                done.set()
+
+    for done in waits:
+        done.wait()
+
+def prefetch(start, end, stations):
+    """
+    Download data for several stations at once, so later fetch_data calls for this time range are served from
+    the cache.
+
+    :param start: (datetime) beginning of time range to pull data for
+    :param end: (datetime) end of time range to pull data for
+    :param stations: (iterable of str) IEM identifiers of the stations to pull data from
+    """
+    _fill_cache([(station, _days(start, end)) for station in set(stations)])
+
+def fetch_data(start, end, station=DEFAULT_PARAMS["station"]):
+    """
+    Makes a pandas DataFrame from an IEM station (Boston Logan by default) from IEM website. Only days that are
+    not cached yet are downloaded, so every station is only downloaded once per run no matter how many sensors use it.
 
     :param start: (datetime) beginning of time range to pull data for
     :param end: (datetime) end of time range to pull data for
+    :param station: (optional str) IEM identifier of the station to pull data from
     :returns: pandas Dataframe containing results
     """
-    uri = make_request_uri(start, end)
-    # fetches data from IEM, data is a formatted string with "," separators
-    data = download_data(uri)
-    #convert string into a stream so that it can be "read" into a pandas dataframe
-    data_stream = StringIO(data)
-    #convert to dataframe
-    df = pd.read_csv(data_stream, sep=",")
-    return df
+    days = _days(start, end)
+    _fill_cache([(station, days)])
+    with _cache_lock:
+        frames = [_cache[(station, day)] for day in days if (station, day) in _cache]
+
+    if not frames:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def nearest_station(lat, lon, stations=STATIONS):
+    """
+    Find the station closest to a location.
+
+    :param lat: (float) latitude of the location in degrees
+    :param lon: (float) longitude of the location in degrees
+    :param stations: (optional dict) station catalog to pick from, see STATIONS
+    :returns: IEM identifier of the nearest station
+    """
+    def distance(station):
+        #haversine distance, the radius of the earth doesn't matter for comparing distances
+        lat1, lon1, lat2, lon2 = map(math.radians, [lat, lon, station["lat"], station["lon"]])
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        return math.asin(math.sqrt(a))
+    return min(stations, key=lambda code: distance(stations[code]))
+
+
+def station_for(sensor_id, location=None):
+    """
+    Pick the station to use for a sensor: the station configured for it in STATION_OVERRIDES_PATH, otherwise the
+    station nearest to its location, otherwise the default station.
+
+    :param sensor_id: (str) serial number of the sensor
+    :param location: (optional dict) location of the sensor with 'lat' and 'lon' keys
+    :returns: IEM identifier of the station
+    """
+    if os.path.exists(STATION_OVERRIDES_PATH):
+        with open(STATION_OVERRIDES_PATH, "r") as f:
+            overrides = json.load(f)
+        if sensor_id in overrides:
+            return overrides[sensor_id]
+    if location is not None:
+        return nearest_station(location["lat"], location["lon"])
+    return DEFAULT_PARAMS["station"]
+
+
+def _to_utc(timestamps):
+    """
+    Convert timestamps to UTC, treating timezone-naive timestamps as UTC.
+
+    :param timestamps: (pd.Series) timestamps
+    :returns: timezone-aware UTC timestamps
+    """
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize("UTC")
+    #merge_asof needs both sides in the same resolution
+    return timestamps.dt.tz_convert("UTC").astype("datetime64[ns, UTC]")
+
+def prepare_weather(iem_df):
+    """
+    Turn data returned by fetch_data into a table of wind direction [deg] and wind speed [m/s], sorted by time.
+
+    :param iem_df: (pd.DataFrame) IEM data as returned by fetch_data
+    :returns: pandas DataFrame with timestamp, wind_dir and wind_speed columns
+    """
+    weather = pd.DataFrame({
+        "timestamp": _to_utc(iem_df["valid"]),
+        "wind_dir": pd.to_numeric(iem_df["drct"], errors="coerce"),
+        "wind_speed": pd.to_numeric(iem_df["sped"], errors="coerce") * MPH_TO_MS,
+    })
+    weather = weather.dropna(subset=["wind_dir", "wind_speed"], how="all")
+    weather = weather.sort_values("timestamp", kind="stable").drop_duplicates("timestamp", keep="last")
+    return weather.reset_index(drop=True)
+
+def join_weather(frames, iem_df, tolerance=JOIN_TOLERANCE):
+    """
+    Add wind_dir and wind_speed columns to sensor data by matching every reading to the latest IEM report before
+    it, within tolerance. Readings before the first report of the range use the first report after them instead.
+    Matching is done on timestamps, so gaps in the sensor data don't shift the weather data, and no minute-by-minute
+    copy of the weather data is made. Any number of sensors can be joined in one call.
+
+    :param frames: (pd.DataFrame or dict of pd.DataFrame) sensor data with a timestamp column, or a dictionary of them
+    :param iem_df: (pd.DataFrame) IEM data as returned by fetch_data
+    :param tolerance: (optional pd.Timedelta) maximum time between a reading and the report it is matched to
+    :returns: the sensor data with wind_dir and wind_speed columns, in the same form as frames
+    """
+    single = isinstance(frames, pd.DataFrame)
+    if single:
+        frames = {None: frames}
+    weather = prepare_weather(iem_df)
+
+    #one sorted table of the timestamps of every sensor, remembering the sensor and row each one came from
+    left = pd.concat([
+        pd.DataFrame({"timestamp": _to_utc(df["timestamp"]).reset_index(drop=True), "frame": i, "row": np.arange(len(df))})
+        for i, df in enumerate(frames.values())
+    ], ignore_index=True)
+    left = left.sort_values("timestamp", kind="stable").reset_index(drop=True)
+
+    joined = pd.merge_asof(left, weather, on="timestamp", direction="backward", tolerance=tolerance)
+    missing = (joined["wind_dir"].isna() & joined["wind_speed"].isna()).to_numpy()
+    if missing.any():
+        ahead = pd.merge_asof(left.loc[missing], weather, on="timestamp", direction="forward", tolerance=tolerance)
+        joined.loc[missing, ["wind_dir", "wind_speed"]] = ahead[["wind_dir", "wind_speed"]].to_numpy()
+
+    #scatter the matched weather back to the rows of each sensor
+    results = {}
+    frame_ids = joined["frame"].to_numpy()
+    for i, (key, df) in enumerate(frames.items()):
+        selected = frame_ids == i
+        rows = joined["row"].to_numpy()[selected]
+        columns = {}
+        for c in ["wind_dir", "wind_speed"]:
+            values = np.full(len(df), np.nan)
+            values[rows] = joined[c].to_numpy()[selected]
+            columns[c] = values
+        results[key] = df.assign(**columns)
+    return results[None] if single else results
 
 
 if __name__ == "__main__":
-    print(fetch_data(datetime.datetime(2012, 8, 1), datetime.datetime(2012, 9, 1)))
\ No newline at end of file
+    print(fetch_data(datetime.datetime(2012, 8, 1), datetime.datetime(2012, 9, 1)))
+    # second request for the same month is served from the cache
+    print(fetch_data(datetime.datetime(2012, 8, 1), datetime.datetime(2012, 9, 1)))
+    print(CACHE_STATS)
\ No newline at end of file
@@ -18,7 +18,7 @@ start, end = datetime(2021, 10, 1), datetime(2021, 10, 10)
 #define a sensor ID to pull data from
 #initialize appropriate hander
 sn_handler = qp.SNHandler(start_date=start, end_date=end)
-#can pull dataframe from API, will return the dataframe and will also pickle the results for you to open and use later
+#can pull dataframe from API, will return the dataframe and will also store the results for you to open and use later
 df = sn_handler.from_api(sn_id)    #this may take several minutes!!
 print(df.head())
 
@@ -0,0 +1,201 @@
+"""
+Project: Air Partners
+Description: Data-quality report for sensor data
+
+A QC record summarizes one sensor's data over one date range: per data column the number of readings, the rates of
+missing, negative, zero and over-cutoff readings, how much of the date range has valid readings, the mean, standard
+deviation and percentiles.
+Records are stored as json next to the cleaned dataframe they describe, so all sensors can be reviewed at once with
+load_reports without re-running ingest.
+"""
+import os
+import glob
+import json
+import warnings
+import numpy as np
+import pandas as pd
+
+# QuantAQ sensors report about once a minute, used to find how many readings a date range should have
+SAMPLE_PERIOD = pd.Timedelta(minutes=1)
+# percentiles reported for every column
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def quality_report(df, cols, cutoff, start=None, end=None):
+    """
+    Compute the QC record of a dataframe. All columns are checked together as one NumPy block, so the data is
+    scanned once instead of once per statistic and column.
+
+    :param df: (pd.DataFrame) sensor data
+    :param cols: (list of str) data columns to check, columns missing from df are skipped
+    :param cutoff: (float) readings above this value count as over the cutoff
+    :param start: (optional datetime) beginning of the date range the data should cover
+    :param end: (optional datetime) end of the date range the data should cover
+    :returns: dictionary with the overall row count, the expected number of readings and one entry per column
+    """
+    cols = [c for c in cols if c in df]
+    values = df[cols].to_numpy(dtype=float)
+    rows = len(values)
+    expected = int((pd.Timestamp(end) - pd.Timestamp(start)) / SAMPLE_PERIOD) if start and end else rows
+
+    missing = np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        counts = {
+            'nan': missing.sum(axis=0),
+            'negative': (values < 0).sum(axis=0),
+            'zero': (values == 0).sum(axis=0),
+            'over_cutoff': (values > cutoff).sum(axis=0),
+        }
+    valid = rows - counts['nan']
+    if rows:
+        #columns without any valid reading warn and are reported as None
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(values, axis=0)
+            std = np.nanstd(values, axis=0, ddof=1)
+            percentiles = np.nanpercentile(values, PERCENTILES, axis=0)
+    else:
+        mean = np.full(len(cols), np.nan)
+        std = np.full(len(cols), np.nan)
+        percentiles = np.full((len(PERCENTILES), len(cols)), np.nan)
+
+    columns = {}
+    for i, col in enumerate(cols):
+        columns[col] = {
+            'count': int(valid[i]),
+            **{f'{name}_rate': _rate(count[i], rows) for name, count in counts.items()},
+            'coverage': _rate(valid[i], expected) if expected else None,
+            'mean': _number(mean[i]),
+            'std': _number(std[i]),
+            **{f'p{p}': _number(percentiles[j, i]) for j, p in enumerate(PERCENTILES)},
+        }
+
+    return {
+        'rows': rows,
+        'expected_rows': expected,
+        'first': _time(df['timestamp'].min()) if rows and 'timestamp' in df else None,
+        'last': _time(df['timestamp'].max()) if rows and 'timestamp' in df else None,
+        'columns': columns,
+    }
+
+
+def combine_reports(first, second):
+    """
+    Combine the QC records of two sets of readings of the same sensor, e.g. of the stored month and of the readings
+    appended to it. The second record covers data appended to the date range of the first, so the expected number
+    of readings is taken from the first. Counts, rates, coverage, mean and standard deviation are exact; the
+    percentiles are count-weighted averages of the two records' percentiles, an approximation.
+
+    :param first: (dict) QC record, see quality_report
+    :param second: (dict) QC record of readings that are not in first
+    :returns: combined QC record
+    """
+    rows = first['rows'] + second['rows']
+    expected = first['expected_rows']
+    columns = {}
+    for col in list(first['columns']) + [c for c in second['columns'] if c not in first['columns']]:
+        a, b = first['columns'].get(col), second['columns'].get(col)
+        if a is None or b is None:
+            columns[col] = dict(a or b)
+            continue
+        count = a['count'] + b['count']
+        stats = {'count': count}
+        for name in ['nan', 'negative', 'zero', 'over_cutoff']:
+            key = f'{name}_rate'
+            stats[key] = _rate((a[key] or 0) * first['rows'] + (b[key] or 0) * second['rows'], rows)
+        stats['coverage'] = _rate(count, expected) if expected else None
+        stats['mean'] = _weighted(a, b, 'mean')
+        stats['std'] = _combined_std(a, b)
+        for p in PERCENTILES:
+            stats[f'p{p}'] = _weighted(a, b, f'p{p}')
+        columns[col] = stats
+
+    times = lambda key, pick: pick([t for t in [first[key], second[key]] if t], default=None)
+    return {
+        'rows': rows,
+        'expected_rows': expected,
+        'first': times('first', min),
+        'last': times('last', max),
+        'columns': columns,
+    }
+
+
+def column_std(report, cols):
+    """
+    :param report: (dict) QC record, see quality_report
+    :param cols: (list of str) data columns
+    :returns: numpy array of the standard deviation of each column, NaN where it is unknown
+    """
+    return np.array([np.nan if report['columns'].get(c, {}).get('std') is None else report['columns'][c]['std']
+                     for c in cols])
+
+
+def save_report(report, path):
+    """
+    :param report: (dict) QC record, see quality_report
+    :param path: (str) json file to write to
+    """
+    with open(path + ".tmp", 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def load_reports(pattern="*/qaq_cleaned_data/*/*_qc.json"):
+    """
+    Collect stored QC records into one table, with a row per sensor, date range and column.
+
+    :param pattern: (optional str) glob pattern of the QC files to load, by default every stored month
+    :returns: pd.DataFrame with 'sn' and 'file' columns identifying the record, 'stage' ('input' for the data
+                as downloaded, 'cleaned' for the stored data) and one column per statistic
+    """
+    rows = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r') as f:
+            record = json.load(f)
+        sn = os.path.basename(os.path.dirname(path))
+        for stage in ['input', 'cleaned']:
+            if stage not in record:
+                continue
+            for col, stats in record[stage]['columns'].items():
+                rows.append({'sn': sn, 'file': os.path.basename(path), 'stage': stage, 'column': col,
+                             'rows': record[stage]['rows'], **stats})
+    return pd.DataFrame(rows)
+
+
+def _rate(count, total):
+    return float(count) / total if total else None
+
+
+def _weighted(a, b, key):
+    """count-weighted average of a statistic of two column records, ignoring records without it"""
+    parts = [(s[key], s['count']) for s in [a, b] if s.get(key) is not None and s['count']]
+    total = sum(count for _, count in parts)
+    return sum(value * count for value, count in parts) / total if total else None
+
+
+def _combined_std(a, b):
+    """sample standard deviation of the readings of two column records, from their counts, means and stds"""
+    count = a['count'] + b['count']
+    if count < 2 or any(s['count'] and s.get('std') is None and s['count'] > 1 for s in [a, b]):
+        return None
+    mean = _weighted(a, b, 'mean')
+    #sum of squared deviations from the combined mean, per record and between the records
+    m2 = sum((s['std'] or 0) ** 2 * (s['count'] - 1) + s['count'] * (s['mean'] - mean) ** 2
+             for s in [a, b] if s['count'])
+    return float(np.sqrt(m2 / (count - 1)))
+
+
+def _number(value):
+    return None if np.isnan(value) else float(value)
+
+
+def _time(value):
+    return None if pd.isna(value) else pd.Timestamp(value).isoformat()
+
+
+if __name__ == "__main__":
+    # python3 -m data_analysis.qc [<glob pattern>], prints the QC records of all stored sensors
+    import sys
+    table = load_reports(*sys.argv[1:])
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(table)
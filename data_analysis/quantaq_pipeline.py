@@ -1,11 +1,20 @@
 from sqlite3 import Timestamp
 from matplotlib.pyplot import axis
 import quantaq
+from quantaq.exceptions import QuantAQAPIException
+from requests.exceptions import RequestException
+import time
 import datetime as dt
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import os
-from data_analysis.iem import fetch_data
+from data_analysis.iem import fetch_data, join_weather, station_for
+from data_analysis.schema import compact, get_location
+from data_analysis.qc import quality_report, save_report, combine_reports, column_std
+from data_analysis.registry import get_registry
+from data_analysis.replay import ReplayClient, RecordingClient, ReplayError
+import json
 import numpy as np
 import pandas as pd
 import pickle
@@ -23,23 +32,164 @@ QuantAQ REST API documentation: https://quant-aq.github.io/py-quantaq/usage.html
 TOKEN_PATH = "token.txt"
 TODAY = datetime.today()
 CUTOFF = 300
+# folder where every downloaded chunk of API data is stored before cleaning
+RAW_CACHE_DIR = "raw_data"
+# sensors upload readings late (e.g. after losing connection), so only chunks that ended at least this many days ago are cached
+CACHE_SETTLE_DAYS = 1
+# compression codec for cleaned dataframes stored as Parquet files
+PARQUET_COMPRESSION = "zstd"
+# final and raw readings further apart than this are not joined, sensors report about once a minute
+MERGE_TOLERANCE = pd.Timedelta(seconds=30)
+# errors a chunk download can fail with: API errors, network errors, failed cache writes and missing replayed responses
+DOWNLOAD_ERRORS = (QuantAQAPIException, RequestException, OSError, ReplayError)
+# number of times a chunk is requested before it counts as failed, and seconds to wait before the first retry
+CHUNK_ATTEMPTS = 3
+RETRY_WAIT = 5
+
+class DownloadError(RuntimeError):
+    """
+    Raised after a download if any of its chunks could not be downloaded. The chunks that did download are cached,
+    so requesting the data again only requests the failed chunks.
+    """
+    def __init__(self, serial_num, failed):
+        """
+        :param serial_num: (str) serial number of the sensor
+        :param failed: (list of date) first days of the chunks that failed
+        """
+        super().__init__(f"{serial_num}: {len(failed)} chunk(s) failed to download, starting {failed}. "
+                         "Run the request again to fetch only the missing chunks.")
+        self.serial_num = serial_num
+        self.failed = failed
 
 class QuantAQHandler:
     """
     Class to fetch data from QuantAQ
     """
-    def __init__(self, token_path):
-        self.token = self._read_token(token_path)
-        self.client = quantaq.QuantAQAPIClient(api_key=self.token)
+    def __init__(self, token_path, cache_dir=RAW_CACHE_DIR, chunk_days=1, client=None):
+        """
+        The QuantAQ API can be replaced by recorded responses (see data_analysis/replay.py): if the QUANTAQ_REPLAY_DIR
+        environment variable is set, responses are replayed from that folder, and if QUANTAQ_RECORD_DIR is set, live
+        responses are also recorded to that folder.
+
+        :param token_path: (str) path to the file containing the QuantAQ API key
+        :param cache_dir: (optional str) folder where downloaded chunks are stored, set to None to disable caching
+        :param chunk_days: (optional int) number of days requested from the API at a time
+        :param client: (optional) client to request data with instead of a live quantaq.QuantAQAPIClient,
+                    e.g. a replay.ReplayClient
+        """
+        if client is None and os.environ.get("QUANTAQ_REPLAY_DIR"):
+            client = ReplayClient(os.environ["QUANTAQ_REPLAY_DIR"])
+        if client is None:
+            self.token = self._read_token(token_path)
+            client = quantaq.QuantAQAPIClient(api_key=self.token)
+            if os.environ.get("QUANTAQ_RECORD_DIR"):
+                client = RecordingClient(client, os.environ["QUANTAQ_RECORD_DIR"])
+        self.client = client
+        self.cache_dir = cache_dir
+        self.chunk_days = chunk_days
 
     def _read_token(self, token_path):
         with open(token_path, 'r') as f:
             token = f.read()
             return token
 
+    def _date_chunks(self, start_date, end_date):
+        """
+        Split a date range into consecutive chunks of self.chunk_days days. Like the API, only the date part of
+        start_date and end_date is used and end_date is exclusive.
+
+        :param start_date: (datetime) beginning of the date range
+        :param end_date: (datetime) end of the date range
+        :returns: list of (chunk_start, chunk_end) date tuples
+        """
+        chunks = []
+        day, stop = start_date.date(), end_date.date()
+        while day < stop:
+            chunk_end = min(day + timedelta(days=self.chunk_days), stop)
+            chunks.append((day, chunk_end))
+            day = chunk_end
+        return chunks
+
+    def _chunk_path(self, serial_num, chunk_start, chunk_end, raw=False):
+        """
+        Get the path of the file a downloaded chunk is cached in.
+
+        :param serial_num: (str) serial number of the sensor
+        :param chunk_start: (date) first day of the chunk
+        :param chunk_end: (date) day after the last day of the chunk
+        :param raw: (optional bool) True if the chunk contains raw data
+        :returns: string path to the cached chunk
+        """
+        folders = os.path.join(self.cache_dir, serial_num, "raw" if raw else "final")
+        return os.path.join(folders, f"{chunk_start.isoformat()}_{chunk_end.isoformat()}.pckl")
+
+    def _request_chunk(self, serial_num, chunk_start, chunk_end, raw=False):
+        """
+        Request one chunk of data, reading it from the cache if it was already downloaded. Chunks that ended at
+        least CACHE_SETTLE_DAYS ago are cached as soon as they arrive.
+
+        :param serial_num: (str) serial number of the sensor
+        :param chunk_start: (date) first day of the chunk
+        :param chunk_end: (date) day after the last day of the chunk
+        :param raw: (optional bool) True if requesting raw data, False otherwise
+        :returns: pandas Dataframe containing the chunk's data
+        """
+        path = self._chunk_path(serial_num, chunk_start, chunk_end, raw) if self.cache_dir else None
+        if path and os.path.exists(path):
+            return pd.read_pickle(path)
+
+        data = self.client.data.list(sn=serial_num, start=chunk_start.strftime("%Y-%m-%d"),
+                                     stop=chunk_end.strftime("%Y-%m-%d"), raw=raw)
+        df = pd.DataFrame(data)
+
+        #recent data may still be arriving, so only cache chunks that have settled
+        if path and chunk_end <= datetime.utcnow().date() - timedelta(days=CACHE_SETTLE_DAYS):
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            #write to a temporary file first so that an interrupted write never leaves a broken chunk behind
+            df.to_pickle(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        return df
+
+    def iter_data(self, serial_num, start_date=TODAY-timedelta(days=2), end_date=TODAY, raw=False):
+        """
+        Request data from QuantAQ's API one chunk at a time, so the caller can process each chunk before the next
+        one is requested and only one chunk of raw API records is held in memory at a time.
+
+        Every chunk is cached as soon as it is downloaded, so if the download fails partway through, running it
+        again only requests the missing chunks.
+
+        :param serial_num: (str) serial number of the sensor
+        :param start_date: (optional datetime) datetime object representing beginning of date range to download data for
+        :param end_date: (optional datetime) represents end of date range to download data for, EXCLUSIVE of the last day
+        :param raw: (optional bool) True if requesting raw data, False otherwise
+        :returns: generator of pandas Dataframes, one per chunk, in chronological order
+        :raises DownloadError: after all other chunks were requested, if any of the chunks could not be downloaded
+        """
+        s = datetime.now()
+        failed = []
+        for chunk_start, chunk_end in self._date_chunks(start_date, end_date):
+            for attempt in range(CHUNK_ATTEMPTS):
+                try:
+                    df = self._request_chunk(serial_num, chunk_start, chunk_end, raw=raw)
+                    break
+                except DOWNLOAD_ERRORS as exp:
+                    print(f"{serial_num}: fetching {chunk_start} to {chunk_end} failed with {exp} "
+                          f"(attempt {attempt + 1} of {CHUNK_ATTEMPTS})")
+                    if attempt < CHUNK_ATTEMPTS - 1:
+                        time.sleep(RETRY_WAIT * 2 ** attempt)
+            else:
+                #every attempt failed, carry on with the other chunks and report this one at the end
+                failed.append(chunk_start)
+                continue
+            yield df
+        print(f"fetching data took {datetime.now()-s} secs")
+
+        if failed:
+            raise DownloadError(serial_num, failed)
+
     def request_data(self, serial_num, start_date=TODAY-timedelta(days=2), end_date=TODAY, raw=False):
         """
-        Request data from QuantAQ's API.
+        Request data from QuantAQ's API. See iter_data for how the request is split into cached chunks.
         
         :param serial_num: (str) serial number of the sensor
         :param start_date: (optional datetime) datetime object representing beginning of date range to download data for
@@ -47,18 +197,13 @@ class QuantAQHandler:
         so end date of 2020-01-03 will return data up until 2020-01-02 at 11:59pm.
         :param raw: (optional bool) True if requesting raw data, False otherwise
         :returns: pandas Dataframe containing data
+        :raises DownloadError: if any of the chunks could not be downloaded
         """
-        #convert datetime start, end to strings
-        start = start_date.strftime("%Y-%m-%d")
-        stop = end_date.strftime("%Y-%m-%d")
-
-        s = datetime.now()
-        #perform QuantAQ request
-        data = self.client.data.list(sn=serial_num, start=start, stop=stop, raw=raw)
-        print(f"fetching data took {datetime.now()-s} secs")
-
-        #convert returned info to pandas df
-        return pd.DataFrame(data)
+        frames = list(self.iter_data(serial_num, start_date, end_date, raw=raw))
+        if not frames:
+            return pd.DataFrame()
+        #combine the chunks into one df
+        return pd.concat(frames, ignore_index=True)
 
 class DataHandler:
     """
@@ -74,6 +219,8 @@ class DataHandler:
         self.data_cols = [col.strip("\n") for col in data_cols]
         self.start = start
         self.end = end
+        #QC record of the data as downloaded, set by check_df
+        self.qc_input = None
         # Convert to date object
         date_obj = dt.date(start.year, start.month, 1)
         # format strings for current and previous month
@@ -109,45 +256,97 @@ class DataHandler:
         # timestamp_local contains local time (but expresses it in UTC, so 18:59 Eastern is expressed as 18:59 UTC)
         # need to change the timezone without altering the hour of day.
         # So, convert to datetime, remove automatically applied UTC timezone, and convert to US/Eastern time.
-        dti = pd.to_datetime(df['timestamp_local']).dt.tz_localize(None).dt.tz_localize('US/Eastern')
-        df = df.assign(timestamp_local=dti)
+        if 'timestamp_local' in df:
+            dti = pd.to_datetime(df['timestamp_local']).dt.tz_localize(None).dt.tz_localize('US/Eastern')
+            df = df.assign(timestamp_local=dti)
 
         #order by timestamp asc instead of desc
         df = df.sort_values(by=['timestamp'])
         return df
 
+    def _flatten(self, df, col, prefix="", names=None, keys=None):
+        """
+        Flatten a column of dictionaries (as returned by the API for nested values) into one column per key.
+        All rows are converted in one pass, which is much faster than building a pd.Series for every row.
+
+        :param df: (pd.DataFrame) dataframe containing sensor data
+        :param col: (str) name of the column containing dictionaries
+        :param prefix: (optional str) prefix added to the name of every new column
+        :param names: (optional list of str) names for the new columns, in the order of the dictionary keys.
+                    overrides prefix
+        :param keys: (optional list of str) if included, only these keys are turned into columns
+        :returns: df with the new columns added and col removed
+        """
+        #rows without a dictionary (i.e. missing values) become rows of NaNs
+        records = [r if isinstance(r, dict) else {} for r in df[col].tolist()]
+        flat = pd.DataFrame.from_records(records, index=df.index, columns=keys)
+        if names is not None:
+            flat.columns = names
+        else:
+            flat = flat.add_prefix(prefix)
+        return pd.concat([df.drop(columns=[col]), flat], axis=1)
+
     def check_df(self, df):
         """
-        visual sanity check that all values for each sensor are within reasonable range
+        Sanity check that all values for each sensor are within reasonable range. The QC record of the data as it
+        came in is kept in self.qc_input and stored next to the cleaned dataframe by save_files.
 
         :param df: (pd.DataFrame) dataframe containing sensor data
-        :returns: None, just prints things
-        """
-        #check number of NA values, zero values, and negative values in each relevant row of the dataset
-        sub_df = df[self.data_cols]
-        zeros = (sub_df == 0).astype(int).sum(axis=0)
-        negs = (sub_df < 0).astype(int).sum(axis=0)
-        nans = (sub_df == np.nan).astype(int).sum(axis=0)
-
-        #calculate mean, 25th and 75th percentile for each relevant column
-        mean = sub_df.mean(axis=0)
-        quantile = sub_df.quantile([0.25, 0.75])
-
-        #print results
-        if zeros.any() > 0:
-            print("---- number of rows that were 0 for each column ----")
-            print(zeros)
-        if negs.any() > 0:
-            print("---- number of rows that were LESS THAN 0 for each column ----")
-            print(negs)
-        if nans.any() > 0:
-            print("---- number of rows that were NaN for each column ----")
-            print(nans)
-
-        print("---- mean of each column ----")
-        print(mean)
-        print("---- 25th and 75th percentile for each column ----")
-        print(quantile)
+        :returns: QC record of df, see qc.quality_report
+        """
+        self.qc_input = quality_report(df, self.data_cols, CUTOFF, self.start, self.end)
+
+        #print a short summary, the full record is stored with the cleaned data
+        flagged = {col: stats for col, stats in self.qc_input['columns'].items()
+                   if stats['nan_rate'] or stats['negative_rate'] or stats['over_cutoff_rate']}
+        print(f"---- {self.qc_input['rows']} rows, {len(flagged)} of {len(self.qc_input['columns'])} columns "
+              f"with missing, negative or over-cutoff values ----")
+        return self.qc_input
+
+    def _clean_kernel(self, df, cols=None, spikes=True, cutoffs=True, smoothed=True, std=None):
+        """
+        Cleaning kernel shared by flags and _cutoffs. Works on all cols at once as one NumPy block and writes
+        the result back to the dataframe in a single assign, instead of copying the whole dataframe several
+        times per column. Spikes are removed before the cutoffs are applied.
+
+        :param df: (pd.DataFrame) dataframe containing sensor data
+        :param cols: (optional list of str) columns to clean, default cleans all self.data_cols
+        :param spikes: (optional bool) True if spikes should be NaN'd, see flags
+        :param cutoffs: (optional bool) True if the hard cutoffs should be applied, see _cutoffs
+        :param smoothed: (optional bool) True if the values > upper threshold should be removed
+        :param std: (optional np.ndarray) standard deviation of each of cols to find spikes with, by default the
+                    standard deviation of df
+        :returns: cleaned copy of df
+        """
+        if not cols:
+            cols = self.data_cols
+        block = df[cols]
+        values = block.to_numpy(dtype=float, copy=True)
+
+        with np.errstate(invalid='ignore'):
+            if spikes:
+                #a reading is a spike if the readings before AND after it are both >= 3 std's smaller
+                if std is None:
+                    std = block.std(axis=0, skipna=True).to_numpy()
+                threshold = values - std * 3
+                after = np.full_like(values, np.nan)
+                after[:-1] = values[1:]
+                before = np.full_like(values, np.nan)
+                before[1:] = values[:-1]
+                values[(after <= threshold) & (before <= threshold)] = np.nan
+
+            if cutoffs:
+                #only edit columns that are not completely empty
+                active = ~np.isnan(values).all(axis=0)
+                block = values[:, active]
+                #values <0 are NaN'd
+                block[block < 0] = np.nan
+                #values over the cutoff are set to 0 if smoothing
+                if smoothed:
+                    block[block > CUTOFF] = 0
+                values[:, active] = block
+
+        return df.assign(**{c: values[:, i] for i, c in enumerate(cols)})
 
     def flags(self, df):
         """
@@ -156,69 +355,51 @@ class DataHandler:
 
         :param df: (pd.DataFrame) dataframe containing sensor data
         """
-        #grab std of each pollutant column
-        sub_df = df[self.data_cols]
-        stdev = sub_df.std(axis=0, skipna=True)
-        for c in self.data_cols:
-            #add 2 new columns, one with the previous pollutant sensor reading, one with the next one
-            df = df.assign(prev=df[c].shift(-1))
-            df = df.assign(next=df[c].shift(1))
-
-            #calculate cutoff for every row: a difference in more than 3 std's
-            threshold = df[c] - (stdev[c] * 3)
-
-            # uncomment these for debugging print statements
-            # print(f"for pollutant: {c}. spikes: ")
-            # print(df.loc[(df.prev <= threshold) & (df.next <= threshold), c])
-            # print(f"before replacing spikes: {df[c].isna().sum()}")
+        return self._clean_kernel(df, spikes=True, cutoffs=False)
 
-            # replace pollutant readings where current-prev AND current-next are both >= threshold
-            df.loc[(df.prev <= threshold) & (df.next <= threshold), c] = np.nan
-            # print(f"after replacing spikes: {df[c].isna().sum()} NaNs")   #for debugging
+    def _merge_final_raw(self, df_fin, df_raw, tolerance=MERGE_TOLERANCE):
+        """
+        Join raw readings onto final readings. The final and raw timestamps of the same reading can differ by a few
+        seconds, so every final row gets the raw row nearest in time (within tolerance) instead of requiring
+        identical timestamps. Final rows without a raw row close enough keep NaN raw columns.
 
-            #remove the temporary columns
-            df = df.drop(columns=['next', 'prev'])
-        return df
+        :param df_fin: (pd.DataFrame) final data, with a 'timestamp' column
+        :param df_raw: (pd.DataFrame) raw data from the same sensor, with a 'timestamp' column
+        :param tolerance: (optional pd.Timedelta) largest time difference between joined rows
+        :returns: combined dataframe, sorted by timestamp
+        """
+        #merge_asof needs sorted, non-null datetime keys
+        def by_time(df):
+            df = df.assign(timestamp=pd.to_datetime(df['timestamp']))
+            return df.dropna(subset=['timestamp']).sort_values('timestamp', kind='stable', ignore_index=True)
+        return pd.merge_asof(by_time(df_fin), by_time(df_raw), on="timestamp", direction="nearest",
+                             tolerance=tolerance)
 
     def _replace_with_iem(self, df, iem_df, is_tz_aware=True):
         """
         Wind speed and wind direction from the QuantAQ sensors are unreliable so we replace them with data from
-        the IEM meteorology sensors.
+        the IEM meteorology sensors. Every reading gets the latest IEM report before it (see iem.join_weather).
 
         :param df: (pd.DataFrame) dataframe containing sensor data
         :param iem_df: (pd.DataFrame) dataframe containing meteorology data
-        :param is_tz_aware: (optional bool) True if the raw, string representations of timestamps in df are time zone-aware
+        :param is_tz_aware: (optional bool) unused, timezone-naive timestamps are treated as UTC
         """
-        #convert str representation of timestamps to datetime
-        iem_df = iem_df.assign(timestamp=pd.to_datetime(iem_df['valid']))
-
-        #IEM data is recorded once every 5 mins, quantAQ data recorded once per minute, need to fill in rows in IEM data
-        # to match quantAQ. So, for every IEM timestamp, we add 4 copies of the IEM data so that the IEM and QuantAQ dataframes
-        # have the same number of rows:
-
-        #create new timestamp column that matches the timestamps for the quantAQ data
-        start, end = df.timestamp.min(), df.timestamp.max()
-        if not is_tz_aware:
-            start, end = start.tz_localize(None), end.tz_localize(None)
-        dates = pd.date_range(start=start, end=end, freq='1Min')
-        #fill new empty rows with the last valid value
-        iem_df['timestamp'] = iem_df['timestamp'].dt.round('1Min') # this operation sometimes adds duplicates by rounding to the same minute.
-        iem_df = iem_df.set_index('timestamp')
-        # delete duplicate timestamps before reindexing, or pandas complains
-        iem_df = iem_df.loc[~iem_df.index.duplicated(), :]
-
-        #reindex meteorology data to match original dataframe
-        iem_df = iem_df.reindex(dates, method='pad')
-
-        #convert timestamp index back into a column
-        iem_df = iem_df.reset_index().rename(columns={"index": "timestamp"})
-        #some values might be NaN due to timestamp mismatch, fill them with the next valid value
-        iem_df = iem_df.fillna(method='bfill')
-
-        #assign the new wind direction and wind speed columns to the quantAQ dataframe
-        df = df.assign(wind_dir=iem_df['drct'])
-        df = df.assign(wind_speed=iem_df['sped'] * (1609/3600))  #converting to m/s, 1609 meters per mile, 3600 seconds per hr
-        return df
+        return join_weather(df, iem_df)
+
+    def _station(self, sensor_id, df=None):
+        """
+        Pick the IEM station to take meteorology data from for a sensor: the one configured for it, otherwise the one
+        closest to its location (see iem.station_for). The location comes from the sensor registry, or from the
+        data if the sensor isn't registered.
+
+        :param sensor_id: (str) unique ID of the QuantAQ sensor
+        :param df: (optional pd.DataFrame) data from the sensor, used to find its location
+        :returns: IEM identifier of the station
+        """
+        location = get_registry().location(sensor_id)
+        if location is None and df is not None:
+            location = get_location(df)
+        return station_for(sensor_id, location)
 
     def _cutoffs(self, df, cols=None, smoothed=True):
         """
@@ -230,46 +411,98 @@ class DataHandler:
         :param smoothed: (optional bool) True if the values > upper threshold should be removed
         :returns: dataframe with values outside of lower and (optionally) upper bounds removed
         """
-        if not cols:
-            cols = self.data_cols
-        for c in cols:
-            if not df[c].isnull().all():    #only edit columns that are not completely empty
-                #values <0 are NaN'd
-                df.loc[df[c] < 0, c] = np.nan
-                #values over 300 are set to 0 if smoothing
-                if smoothed:
-                    df.loc[df[c] > CUTOFF, c] = 0
-        return df
+        return self._clean_kernel(df, cols=cols, spikes=False, cutoffs=True, smoothed=smoothed)
+
+    def get_save_folder(self, sensor):
+        """
+        Get the folder that cleaned dataframes for a sensor are stored in.
+
+        :param sensor: (str) unique ID of the QuantAQ sensor
+        :returns: string path of the folder
+        """
+        return f"{self.year_month}/qaq_cleaned_data/{sensor}"
 
     def save_files(self, df, sensor, smoothed=True):
         """
-        Save a cleaned Dataframe as a pickle file for now
-        TODO: if the files become too large we can switch over to using Apache feather files which have better compression for dfs
-        specifically but don't play well with edits (i.e. better to open->read->make edits in Python->create+store in a new file)
+        Save a cleaned Dataframe as a compressed Parquet file. Parquet stores every column separately, so
+        load_df can read only the columns a plot needs instead of the whole dataframe.
         
         :param df: (pd.DataFrame) dataframe to save
         :param smoothed: (optional bool) True if the dataframe was smoothed
         :returns: None
         """
         #create the save path, including missing folders, if it doesn't exist yet
-        folders = f"{self.year_month}/qaq_cleaned_data/{sensor}"
+        folders = self.get_save_folder(sensor)
         Path(folders).mkdir(parents=True, exist_ok=True)
-        with open(os.path.join(folders, f"{self.get_save_name(smoothed=smoothed)}.pckl"), 'wb') as f:
-            pickle.dump(df, f)
-
-    def load_df(self, sensor, start=None, end=None, smoothed=True):
-        """
-        Load a stored Dataframe from a pickle file
+        save_name = self.get_save_name(smoothed=smoothed)
+        #write to a temporary file and move it into place, so a failed write doesn't destroy the stored month
+        path = os.path.join(folders, f"{save_name}.parquet")
+        df.to_parquet(path + ".tmp", engine="pyarrow", compression=PARQUET_COMPRESSION)
+        os.replace(path + ".tmp", path)
+        #per-sensor metadata (e.g. the sensor location) is kept in df.attrs, which Parquet files don't store
+        #the normalized flag describes the in-memory index, which isn't what gets stored
+        path = os.path.join(folders, f"{save_name}_attrs.json")
+        with open(path + ".tmp", 'w') as f:
+            json.dump({k: v for k, v in df.attrs.items() if k != 'normalized'}, f)
+        os.replace(path + ".tmp", path)
+        #QC record of the data as downloaded (if check_df ran on it) and as stored
+        record = {'cleaned': quality_report(df, self.data_cols, CUTOFF, self.start, self.end)}
+        if self.qc_input is not None:
+            record['input'] = self.qc_input
+        save_report(record, os.path.join(folders, f"{save_name}_qc.json"))
+
+    def load_df(self, sensor, start=None, end=None, smoothed=True, columns=None):
+        """
+        Load a stored Dataframe from a Parquet file. Dataframes saved as pickle files by older versions of
+        the pipeline are still read if no Parquet file exists.
 
         :param start: (optional datetime) If included, the start date of the file to open. defaults to self.start
         :param end: (optional datetime) If included, the end date of the file to open. defaults to self.end
         :param smoothed: (optional bool) True if loading a smoothed dataframe
+        :param columns: (optional list of str) if included, only these columns are loaded
         :returns: loaded dataframe
+        :raises FileNotFoundError: if no dataframe was stored for this sensor and date range
         """
-        folders = f"{self.year_month}/qaq_cleaned_data/{sensor}"
+        folders = self.get_save_folder(sensor)
         save_name = self.get_save_name(smoothed=smoothed, start=start, end=end)
+        path = os.path.join(folders, f"{save_name}.parquet")
+        if os.path.exists(path):
+            df = pd.read_parquet(path, engine="pyarrow", columns=columns)
+            attrs_path = os.path.join(folders, f"{save_name}_attrs.json")
+            if os.path.exists(attrs_path):
+                with open(attrs_path, 'r') as f:
+                    df.attrs = json.load(f)
+            return df
+
+        #legacy pickle files have to be read whole
         with open(os.path.join(folders, f"{save_name}.pckl"), 'rb') as f:
-            return pickle.load(f)
+            df = pickle.load(f)
+        return df[columns] if columns else df
+
+    def has_df(self, sensor, smoothed=True):
+        """
+        Check whether a dataframe is stored for this sensor and date range, without loading it.
+
+        :param sensor: (str) unique ID of the QuantAQ sensor
+        :param smoothed: (optional bool) True if checking for a smoothed dataframe
+        :returns: True if load_df has a Parquet or legacy pickle file to read
+        """
+        path = os.path.join(self.get_save_folder(sensor), self.get_save_name(smoothed=smoothed))
+        return os.path.exists(f"{path}.parquet") or os.path.exists(f"{path}.pckl")
+
+    def load_qc(self, sensor, smoothed=True):
+        """
+        Load the QC record stored next to a cleaned dataframe by save_files.
+
+        :param sensor: (str) unique ID of the QuantAQ sensor
+        :param smoothed: (optional bool) True if the record belongs to a smoothed dataframe
+        :returns: dictionary with 'cleaned' and (if it was recorded) 'input' QC records, or None if there is none
+        """
+        path = os.path.join(self.get_save_folder(sensor), f"{self.get_save_name(smoothed=smoothed)}_qc.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
         
 class SNHandler(DataHandler):
     """
@@ -288,8 +521,10 @@ class SNHandler(DataHandler):
         #define the columns we care about for the raw and final datasets
         self.final_cols = ["timestamp", "timestamp_local", "temp_box", "temp_manifold", "rh_manifold", "pressure", "noise", "solar", "wind_dir", "wind_speed", "co", "no", "no2", "o3", "pm1", "pm25", "pm10", "co2"]
         self.raw_cols = ["timestamp", "bin0", "bin1", "bin2", "bin3", "bin4", "bin5", "no_ae", "co_ae", "no2_ae"]
+        #columns read from final and raw csv exports by the bulk importer
+        self.csv_cols = (self.final_cols, self.raw_cols)
 
-    def _clean_df(self, df, smoothed=True, local=False):
+    def _clean_df(self, df, smoothed=True, local=False, station=None):
         """
         Cleans the dataframe from anomalies, parses timestamps, and adds wind_speed, wind_dir columns with reliable
         meteorology data from IEM.
@@ -297,6 +532,7 @@ class SNHandler(DataHandler):
         :param df: (pd.DataFrame) combined raw/final dataframe to clean
         :param smoothed: (optional bool) True if unrealistically large values should be removed
         :param local: (optional bool) True if the dataframe originated from a local CSV file (as opposed to being pulled via API)
+        :param station: (optional str) IEM station to take meteorology data from, Boston Logan if not given
         :returns: the cleaned dataframe with combined raw/final results
         """
         #sanity check the df before cleaning
@@ -315,7 +551,7 @@ class SNHandler(DataHandler):
         if local:
             self.start, self.end = df.timestamp.min().tz_localize(None), df.timestamp.max().tz_localize(None)
         #request data from IEM
-        iem_df = fetch_data(self.start, self.end)
+        iem_df = fetch_data(self.start, self.end, station=station or self._station(None))
 
         #replace meteorology columns
         df = self._replace_with_iem(df, iem_df, is_tz_aware=False)
@@ -338,17 +574,28 @@ class SNHandler(DataHandler):
         """
         #read final csv
         df_fin = pd.read_csv(final_path, sep=",")
-        df_fin = df_fin[self.final_cols]
 
         #read raw csv
         df_raw = pd.read_csv(raw_path)
-        df_raw = df_raw[self.raw_cols]
 
+        return self.from_frames(sensor_id, df_fin, df_raw, smoothed=smoothed)
+
+    def from_frames(self, sensor_id, df_fin, df_raw, smoothed=True, local=True):
+        """
+        Creates and stores a cleaned dataframe from final and raw data that was already read from files.
+
+        :param sensor_id: (str) unique ID of the QuantAQ sensor that the data originated from
+        :param df_fin: (pd.DataFrame) final data columns from an SN sensor
+        :param df_raw: (pd.DataFrame) raw data columns from the same sensor
+        :param smoothed: (optional bool) True if unrealistically large values should be removed
+        :param local: (optional bool) True if the date range should be taken from the data instead of this handler
+        :returns: the cleaned dataframe with combined raw/final results
+        """
         #combine dataframes
-        df = df_fin.merge(df_raw, on="timestamp")
+        df = self._merge_final_raw(df_fin[self.final_cols], df_raw[self.raw_cols])
 
         #clean dataframe
-        df = self._clean_df(df, smoothed=smoothed, local=True)
+        df = self._clean_df(df, smoothed=smoothed, local=local, station=self._station(sensor_id))
 
         #store the cleaned df
         self.save_files(df, sensor_id, smoothed=smoothed)
@@ -367,24 +614,19 @@ class SNHandler(DataHandler):
         :param smoothed: (optional bool) True if unrealistically large values should be removed
         :returns: cleaned pandas dataframe
         """
-        #initialize client class for requesting data from QuantAQ
-        client = QuantAQHandler(TOKEN_PATH)
-
-        #get the final data from quantAQ, NOTE: SLOW! MAY TAKE SEVERAL MINUTES!
-        print("pulling final data...")
-        data = client.request_data(sensor_id, self.start, self.end)
-        data = data[self.final_cols]
-
-        #get the raw data from the same sensor, NOTE: SLOW! MAY TAKE SEVERAL MINUTES!
-        print("pulling raw data...")
-        data_raw = client.request_data(sensor_id, self.start, self.end, raw=True)
-        data_raw = data_raw[self.raw_cols]
+        #pull the final and raw data at the same time, each with its own client. NOTE: SLOW! MAY TAKE SEVERAL MINUTES!
+        print("pulling final and raw data...")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            final = pool.submit(QuantAQHandler(TOKEN_PATH).request_data, sensor_id, self.start, self.end)
+            raw = pool.submit(QuantAQHandler(TOKEN_PATH).request_data, sensor_id, self.start, self.end, raw=True)
+            data = final.result()[self.final_cols]
+            data_raw = raw.result()[self.raw_cols]
 
         #combine the raw/final dataframes
-        df = data.merge(data_raw, on="timestamp")
+        df = self._merge_final_raw(data, data_raw)
 
         #clean the df
-        df = self._clean_df(df, smoothed=smoothed)
+        df = self._clean_df(df, smoothed=smoothed, station=self._station(sensor_id))
 
         #store the cleaned df
         self.save_files(df, sensor_id, smoothed=smoothed)
@@ -415,34 +657,27 @@ class ModPMHandler(DataHandler):
             start=start_date,
             end=end_date
         )
+        #columns read from final and raw csv exports by the bulk importer. pm readings come from the final data,
+        #the raw data only adds the sensor's metadata and meteorology
+        self.csv_cols = (["timestamp", "pm1", "pm25", "pm10", "pm1_model_id", "pm25_model_id", "pm10_model_id"],
+                         ["timestamp", "sn", "model", "rh", "temp"])
 
 
-    def _clean_mod_pm(self, df, smoothed=True, raw=False):
+    def _flatten_mod_pm(self, df, raw=False):
         """
-        Flatten dataframe received from the MOD-PM sensors. This method is a helper function for data fetched via
-        REST API. only data from the API have nested columns, the CSV's do not.
-        
+        Flatten the nested columns of data received from the MOD-PM sensors via REST API and drop the columns that
+        are not used. Works on any subset of rows, so it can be applied to each chunk of a streamed download.
+
         :param df: (pd.DataFrame) dataframe containing mod-pm data
-        :param smoothed: (optional bool) True if unrealistically large values should be removed
-        :param nested: (optional bool) True if columns contain nested values (MOD-PM sensor data returns nested if pulled via API)
-        :returns: cleaned dataframe
+        :param raw: (optional bool) True if df contains raw data
+        :returns: flattened dataframe with parsed timestamps
         """
-        #replace timestamp info
-        print(df.columns)
-        df = self.convert_timestamps(df)
-
         if raw:
-            #create column names based on all keys within the dictionary
-            neph_cols = [f"neph_{k}" for k in df['neph'][0].keys()]
-            opc_cols = [f"opc_{k}" for k in df['opc'][0].keys()]
-
-            #flatten columns that contain dictionaries
-            df[neph_cols] = df.neph.apply(pd.Series)
-            df[opc_cols] = df.opc.apply(pd.Series)
-            df[['pressure', 'rh', 'temp']] = df.met.apply(pd.Series)
-
-            #drop columns that contain dictionaries after flattening
-            df = df.drop(['neph', 'opc', 'met'], axis=1)
+            #flatten columns that contain dictionaries. bin columns are removed below anyway, so don't create them
+            keep_keys = lambda c: [k for k in df[c].iloc[0].keys() if 'bin' not in k]
+            df = self._flatten(df, 'neph', prefix='neph_', keys=keep_keys('neph'))
+            df = self._flatten(df, 'opc', prefix='opc_', keys=keep_keys('opc'))
+            df = self._flatten(df, 'met', names=['pressure', 'rh', 'temp'])
 
             # Remove all bin columns from dataframe. 
             df = df[df.columns.drop(list(df.filter(regex='bin')))]
@@ -451,40 +686,89 @@ class ModPMHandler(DataHandler):
             df = df.drop(['timestamp_local', 'url', 'opc_rh', 'opc_temp', 'pressure'], axis = 1)
         else:
             if not (set(['rh', 'temp']).issubset(df.columns)):
-                df[['rh', 'temp']] = df.met.apply(pd.Series)
-            df = df.drop(['url', 'met', 'timestamp_local'], axis = 1)
+                df = self._flatten(df, 'met', names=['rh', 'temp'])
+            df = df.drop(['url', 'met', 'timestamp_local'], axis = 1, errors='ignore')
+
+        #timestamp strings take several times the memory of parsed timestamps
+        return df.assign(timestamp=pd.to_datetime(df['timestamp']))
+
+    def _stream_mod_pm(self, client, sensor_id, start, end, raw=False):
+        """
+        Download MOD-PM data one chunk at a time, flattening each chunk as soon as it arrives. Only one chunk of
+        nested API records is in memory at a time, so peak memory stays close to the size of the final dataframe.
+
+        :param client: (QuantAQHandler) client used to request the data
+        :param sensor_id: (str) unique ID of the QuantAQ sensor to pull data from
+        :param start: (datetime) beginning of the date range
+        :param end: (datetime) end of the date range, exclusive
+        :param raw: (optional bool) True if requesting raw data
+        :returns: flattened dataframe of all chunks
+        """
+        frames = [self._flatten_mod_pm(page, raw=raw)
+                  for page in client.iter_data(sensor_id, start, end, raw=raw) if not page.empty]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def _clean_mod_pm(self, df, smoothed=True, raw=False, flattened=False, since=None, qc_base=None):
+        """
+        Flatten dataframe received from the MOD-PM sensors. This method is a helper function for data fetched via
+        REST API. only data from the API have nested columns, the CSV's do not.
+
+        When new data is appended to data that was cleaned before (see update_from_api), qc_base is the QC record
+        of the earlier input. The QC record of the new rows is combined with it, and spikes are found with the
+        standard deviation of all of the input, as if the whole date range was cleaned at once.
+        
+        :param df: (pd.DataFrame) dataframe containing mod-pm data
+        :param smoothed: (optional bool) True if unrealistically large values should be removed
+        :param raw: (optional bool) True if df contains raw data
+        :param flattened: (optional bool) True if df was already flattened by _flatten_mod_pm
+        :param since: (optional timestamp) only rows after it are new; older rows are only used as neighbors of
+                    the new rows for spike detection and are not part of the QC record
+        :param qc_base: (optional dict) QC record of the input cleaned before, see qc.combine_reports
+        :returns: cleaned dataframe
+        """
+        print(df.columns)
+        if not flattened:
+            df = self._flatten_mod_pm(df, raw=raw)
+
+        #replace timestamp info
+        df = self.convert_timestamps(df)
 
         #drop duplicate rows. Timestamps don't properly get recognized as duplicates, so use data_cols.
         df = df.drop_duplicates(subset = self.data_cols, ignore_index=True)
 
         #visual sanity check df columns
-        self.check_df(df)
+        self.check_df(df if since is None else df.loc[df['timestamp'] > since])
+        std = None
+        if qc_base is not None:
+            self.qc_input = combine_reports(qc_base, self.qc_input)
+            std = column_std(self.qc_input, self.data_cols)
 
-        #clean spikes
-        df = self.flags(df)
-        df = self._cutoffs(df, smoothed=smoothed)
+        #clean spikes and values outside of the valid range in one pass
+        df = self._clean_kernel(df, smoothed=smoothed, std=std)
 
         return df
 
-    def _iem(self, df, is_tz_aware=True):
+    def _iem(self, df, is_tz_aware=True, station=None):
         """
         Add wind direction and speed data to MOD-PM sensors by pulling from IEM website.
 
         :param df: (pd.DataFrame) dataframe containing mod-pm data
         :param is_tz_aware: (optional bool) True if the raw, string representations of timestamps in df are time zone-aware
+        :param station: (optional str) IEM station to take meteorology data from, by default the one closest to the sensor
         :returns: dataframe with added wind_speed, wind_dir columns
         """
-        #request data from IEM
-        iem_df = fetch_data(self.start, self.end)
+        #request data from IEM, cached per station so sensors sharing a station share the download
+        if station is None:
+            station = self._station(df['sn'].iloc[0] if 'sn' in df and len(df) else None, df)
+        iem_df = fetch_data(self.start, self.end, station=station)
 
         #add wind direction and speed to df
-        #wind_dir and wind_speed columns are not included in original df so we need to add them
-        df = df.assign(wind_dir=np.zeros_like(df['timestamp']))
-        df = df.assign(wind_speed=np.zeros_like(df['timestamp']))
         df = self._replace_with_iem(df, iem_df, is_tz_aware=is_tz_aware)
         return df
 
-    def from_api(self, sensor_id, smoothed=True):
+    def from_api(self, sensor_id, smoothed=True, streaming=True):
         """
         Build a cleaned dataframe containing data for a MOD-PM sensor by pulling data from the QuantAQ website over
         the network (requires internet connection). Note that pulling data this way is slow, about
@@ -492,10 +776,16 @@ class ModPMHandler(DataHandler):
 
         :param sensor_id: (str) unique ID of the QuantAQ sensor to pull data from
         :param smoothed: (optional bool) True if unrealistically large values should be removed
+        :param streaming: (optional bool) True if each downloaded chunk should be flattened as it arrives, which keeps
+                    peak memory close to the size of the cleaned dataframe
         :returns: cleaned pandas dataframe
         """
         client = QuantAQHandler(TOKEN_PATH) #TODO make this not rely on a global variable token_path?
-        df = client.request_data(sensor_id, self.start, self.end, raw=False)
+        if streaming:
+            #flatten every chunk as it arrives instead of holding the whole month of nested records
+            df = self._stream_mod_pm(client, sensor_id, self.start, self.end, raw=False)
+        else:
+            df = client.request_data(sensor_id, self.start, self.end, raw=False)
         
         # check for empty dataframe
         if df.empty:
@@ -504,16 +794,80 @@ class ModPMHandler(DataHandler):
         print('Downloaded from API')
         #print(df.dtypes)
         # flatten and clean the dataframe
-        df = self._clean_mod_pm(df, smoothed=smoothed, raw=False)
+        df = self._clean_mod_pm(df, smoothed=smoothed, raw=False, flattened=streaming)
 
-        #add wind direction and speed to df from iem
-        df = self._iem(df)
+        #add wind direction and speed to df from the iem station closest to the sensor
+        df = self._iem(df, station=self._station(sensor_id, df))
+
+        #float32 measurements, categorical sn/model and one location instead of a geo dict per row
+        df = compact(df)
 
         #store cleaned df
         self.save_files(df, sensor_id, smoothed=smoothed)
 
         return df
 
+    def update_from_api(self, sensor_id, smoothed=True):
+        """
+        Incrementally update the stored cleaned dataframe for this date range. Only data newer than the last
+        stored timestamp is requested from the API; it is cleaned and appended to the stored dataframe. Meant to
+        be run daily so that the monthly report only has to read local data.
+
+        :param sensor_id: (str) unique ID of the QuantAQ sensor to pull data from
+        :param smoothed: (optional bool) True if unrealistically large values should be removed
+        :returns: the updated cleaned pandas dataframe
+        """
+        try:
+            stored = self.load_df(sensor_id, smoothed=smoothed)
+        #a store that can't be read (e.g. truncated by an interrupted write) is rebuilt like a missing one
+        except (OSError, ValueError):
+            stored = None
+
+        #the API only accepts dates, so request from the day of the last stored timestamp and drop the rows we already have
+        fetch_start = self.start
+        last, qc_base = None, None
+        if stored is not None and not stored.empty:
+            last = stored['timestamp'].max()
+            fetch_start = datetime(last.year, last.month, last.day)
+            #QC record of the stored input, to combine with the new rows. Records saved before it had a standard
+            #deviation can't be combined
+            qc_base = (self.load_qc(sensor_id, smoothed=smoothed) or {}).get('input')
+            if qc_base is not None and any('std' not in stats for stats in qc_base['columns'].values()):
+                qc_base = None
+        #end date is exclusive, so ask for tomorrow to include everything that has arrived today
+        today = datetime.utcnow()
+        fetch_end = min(self.end, datetime(today.year, today.month, today.day) + timedelta(days=1))
+        if fetch_start >= fetch_end:
+            return stored
+
+        client = QuantAQHandler(TOKEN_PATH)
+        #a handler covering only the fetched window, so IEM data is requested for that window only
+        window = ModPMHandler(start_date=fetch_start, end_date=fetch_end)
+        df = window._stream_mod_pm(client, sensor_id, fetch_start, fetch_end, raw=False)
+        if df.empty:
+            return stored if stored is not None else df
+
+        #clean with this handler, so the QC record covers the whole date range and spikes are found with the spread of
+        #all the month's input. Rows already stored are only used as neighbors of the first new rows
+        df = self._clean_mod_pm(df, smoothed=smoothed, raw=False, flattened=True, since=last, qc_base=qc_base)
+        if last is not None and qc_base is None:
+            #the input record would only cover the new rows
+            self.qc_input = None
+        df = window._iem(df, station=self._station(sensor_id, df if get_location(df) else stored))
+
+        df = compact(df)
+        if stored is not None and not stored.empty:
+            attrs = {**stored.attrs, **df.attrs}
+            df = df.loc[df['timestamp'] > last]
+            #compact again since combining categories of the two dataframes falls back to plain objects
+            df = compact(pd.concat([stored, df], ignore_index=True))
+            df.attrs = attrs
+
+        #store the combined df under this handler's date range
+        self.save_files(df, sensor_id, smoothed=smoothed)
+
+        return df
+
     def from_csv(self, sensor_id, final_path, raw_path, smoothed=True):
         """
         Creates a cleaned dataframe based on locally stored raw and final .csv files. It is the caller's responsibility
@@ -537,26 +891,42 @@ class ModPMHandler(DataHandler):
             "neph_bin2","neph_bin3","neph_bin4","neph_bin5",
             "pm1", "pm10", "pm25"
         ]
-        #columns to keep from the final dataset, many of the columns are already present in the raw data
-        final_cols = ["timestamp","pm1","pm25","pm10","pm1_model_id","pm25_model_id","pm10_model_id"]
-
         #read final csv into df
         df_fin = pd.read_csv(final_path)
-        df_fin = df_fin[final_cols]
 
         #read raw csv into df
         df_raw = pd.read_csv(raw_path)
+
+        return self.from_frames(sensor_id, df_fin, df_raw, smoothed=smoothed)
+
+    def from_frames(self, sensor_id, df_fin, df_raw, smoothed=True, local=True):
+        """
+        Creates and stores a cleaned dataframe from final and raw data that was already read from files.
+
+        :param sensor_id: (str) unique ID of the QuantAQ sensor that the data originated from
+        :param df_fin: (pd.DataFrame) final data columns from a MOD-PM sensor
+        :param df_raw: (pd.DataFrame) raw data columns from the same sensor
+        :param smoothed: (optional bool) True if unrealistically large values should be removed
+        :param local: (optional bool) True if the date range should be taken from the data instead of this handler
+        :returns: the cleaned dataframe with combined raw/final results
+        """
+        #columns to keep from the final dataset, many of the columns are already present in the raw data
+        df_fin = df_fin[[c for c in self.csv_cols[0] if c in df_fin]]
+
         #combine raw/final dataframes
-        df = df_fin.merge(df_raw, on="timestamp")
+        df = self._merge_final_raw(df_fin, df_raw)
 
         #clean dataframe
         df = self._clean_mod_pm(df, smoothed=smoothed)
 
         #find start and end times from the local file to inform IEM request
-        self.start, self.end = df.timestamp.min().tz_localize(None), df.timestamp.max().tz_localize(None)
+        if local:
+            self.start, self.end = df.timestamp.min().tz_localize(None), df.timestamp.max().tz_localize(None)
 
         #add wind direction and speed to df from iem
-        df = self._iem(df, is_tz_aware=False)
+        df = self._iem(df, is_tz_aware=False, station=self._station(sensor_id, df))
+
+        df = compact(df)
 
         #store the cleaned df
         self.save_files(df, sensor_id, smoothed=smoothed)
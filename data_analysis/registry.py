@@ -0,0 +1,153 @@
+"""
+Project: Air Partners
+Description: Registry of QuantAQ sensor metadata
+
+The registry keeps, for every sensor on the QuantAQ account, its serial number, model, city, location, deployment
+state and the last time it reported. It is refreshed from client.devices.list at most once per run and saved to
+REGISTRY_PATH, so later lookups (and runs without API access) read the saved copy instead of the API or the data.
+"""
+import os
+import re
+import json
+import threading
+from datetime import datetime
+import pandas as pd
+
+# where the registry is saved between runs
+REGISTRY_PATH = "sensor_registry.json"
+# fields kept for every sensor
+FIELDS = ["sn", "model", "city", "lat", "lon", "status", "outdoors", "last_seen"]
+
+# registry of the current run, see get_registry
+_registry = None
+_refreshed = False
+_lock = threading.Lock()
+
+
+def like(pattern, value):
+    """
+    Match a value against a pattern of the QuantAQ API's "like" filter (SQL LIKE): '%' matches any number of
+    characters, '_' exactly one, and the match is case sensitive.
+
+    :param pattern: (str) LIKE pattern, e.g. '%_oxbury%'
+    :param value: (str) value to match, None never matches
+    :returns: True if the whole value matches the pattern
+    """
+    if value is None:
+        return False
+    regex = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern)
+    return re.fullmatch(regex, value, re.DOTALL) is not None
+
+
+class SensorRegistry(object):
+    """
+    Sensor metadata by serial number.
+    """
+    def __init__(self, sensors=None, updated=None):
+        """
+        :param sensors: (optional dict) {sn: record} where every record has the keys in FIELDS
+        :param updated: (optional str) ISO time of the device list the registry was built from
+        """
+        self.sensors = sensors or {}
+        self.updated = updated
+
+    @classmethod
+    def from_devices(cls, devices):
+        """
+        Build a registry from the response of client.devices.list.
+
+        :param devices: (list of dict) QuantAQ device records
+        :returns: SensorRegistry
+        """
+        sensors = {}
+        for device in devices:
+            geo = device.get("geo") or {}
+            sensors[device["sn"]] = {
+                "sn": device["sn"],
+                "model": device.get("model"),
+                "city": device.get("city"),
+                "lat": geo.get("lat"),
+                "lon": geo.get("lon"),
+                "status": device.get("status"),
+                "outdoors": device.get("outdoors"),
+                "last_seen": device.get("last_seen"),
+            }
+        return cls(sensors, updated=datetime.utcnow().isoformat())
+
+    @classmethod
+    def load(cls, path=REGISTRY_PATH):
+        """
+        :param path: (optional str) json file the registry was saved to
+        :returns: the saved SensorRegistry, or an empty one if nothing was saved yet
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r") as f:
+            saved = json.load(f)
+        return cls(saved["sensors"], updated=saved.get("updated"))
+
+    def save(self, path=REGISTRY_PATH):
+        """
+        :param path: (optional str) json file to save the registry to
+        """
+        with open(path + ".tmp", "w") as f:
+            json.dump({"updated": self.updated, "sensors": self.sensors}, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def get(self, sn):
+        """
+        :param sn: (str) serial number of the sensor
+        :returns: the sensor's record, or None if the sensor is unknown
+        """
+        return self.sensors.get(sn)
+
+    def location(self, sn):
+        """
+        :param sn: (str) serial number of the sensor
+        :returns: dictionary with 'lat' and 'lon' keys, or None if the location is unknown
+        """
+        record = self.sensors.get(sn)
+        if record is None or record["lat"] is None or record["lon"] is None:
+            return None
+        return {"lat": float(record["lat"]), "lon": float(record["lon"])}
+
+    def serials(self, city=None, model=None):
+        """
+        :param city: (optional str) pattern the sensor's city has to match, in the syntax of the QuantAQ API's city
+            filter (see like), so the registry selects the same sensors as e.g. filter="city,like,%_oxbury%"
+        :param model: (optional str) model the sensor has to be, e.g. 'modulair_pm'
+        :returns: sorted list of serial numbers of the matching sensors
+        """
+        return sorted(sn for sn, record in self.sensors.items()
+                      if (city is None or like(city, record["city"]))
+                      and (model is None or record["model"] == model))
+
+    def to_dataframe(self):
+        """
+        :returns: pd.DataFrame with a row per sensor and a column per field
+        """
+        return pd.DataFrame(list(self.sensors.values()), columns=FIELDS)
+
+
+def get_registry(client=None, path=REGISTRY_PATH):
+    """
+    Get the sensor registry of this run. The first call with a client refreshes the registry from the device list
+    and saves it; every other call returns the same registry. Without a client, or if the device list can't be
+    requested, the saved registry is used.
+
+    :param client: (optional) QuantAQ client, e.g. quantaq.QuantAQAPIClient or replay.ReplayClient
+    :param path: (optional str) json file the registry is saved to
+    :returns: SensorRegistry
+    """
+    global _registry, _refreshed
+    with _lock:
+        if client is not None and not _refreshed:
+            _refreshed = True
+            try:
+                _registry = SensorRegistry.from_devices(client.devices.list())
+                _registry.save(path)
+            except Exception as exp:
+                print(f"could not refresh the sensor registry, using the saved one: {exp}")
+        if _registry is None:
+            _registry = SensorRegistry.load(path)
+        return _registry
@@ -0,0 +1,245 @@
+"""
+Project: Air Partners
+Description: Record and replay responses of the QuantAQ API and the IEM mesonet, so ingest can be run, measured
+and regression tested offline.
+
+Fixtures are stored in a folder with this layout:
+    <fixture_dir>/quantaq/devices.json
+    <fixture_dir>/quantaq/data/<sn>/<final|raw>/<start>_<stop>.json
+    <fixture_dir>/iem/<sha1 of the request query string>.csv
+
+To record, point the pipeline at a fixture folder before running it:
+    QUANTAQ_RECORD_DIR=fixtures/2022-06 IEM_RECORD_DIR=fixtures/2022-06 python3 import_data.py 2022 6
+
+To replay, QuantAQHandler picks up QUANTAQ_REPLAY_DIR and IEM requests can be sent to a ReplayServer:
+    with ReplayServer("fixtures/2022-06", latency=0.5, failure_rate=0.1) as server:
+        iem.SERVICE = server.service_url
+        ...
+
+Replayed data goes through the raw_data chunk cache like live data, so pass cache_dir=None to QuantAQHandler when
+benchmarking.
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+from pathlib import Path
+from urllib import parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ReplayError(Exception):
+    """
+    Raised by ReplayClient for an injected failure or a request that was never recorded.
+    """
+
+
+def _data_path(fixture_dir, sn, start, stop, raw):
+    return os.path.join(fixture_dir, "quantaq", "data", sn, "raw" if raw else "final", f"{start}_{stop}.json")
+
+
+def _devices_path(fixture_dir):
+    return os.path.join(fixture_dir, "quantaq", "devices.json")
+
+
+def iem_fixture_path(fixture_dir, uri):
+    """
+    Path of the fixture an IEM request is recorded in, keyed by the request's query string.
+
+    :param fixture_dir: (str) fixture folder
+    :param uri: (str) full request URI or only its query string
+    :returns: string path to the fixture
+    """
+    query = uri.split("?", 1)[-1]
+    return os.path.join(fixture_dir, "iem", hashlib.sha1(query.encode("utf-8")).hexdigest() + ".csv")
+
+
+def _write_json(path, data):
+    Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+class _Recorder(object):
+    """
+    Stand-in for one domain of the py-quantaq client (e.g. client.data) that records every response.
+    """
+    def __init__(self, domain, save):
+        self.domain = domain
+        self.save = save
+
+    def list(self, **kwargs):
+        data = self.domain.list(**kwargs)
+        self.save(kwargs, data)
+        return data
+
+
+class RecordingClient(object):
+    """
+    Wraps a py-quantaq client and saves the device list and every data request to fixture_dir.
+    """
+    def __init__(self, client, fixture_dir):
+        """
+        :param client: (quantaq.QuantAQAPIClient) client used for the live requests
+        :param fixture_dir: (str) folder to save the responses in
+        """
+        self.devices = _Recorder(client.devices, lambda kwargs, data: _write_json(_devices_path(fixture_dir), data))
+        self.data = _Recorder(client.data, lambda kwargs, data: _write_json(
+            _data_path(fixture_dir, kwargs["sn"], kwargs["start"], kwargs["stop"], kwargs.get("raw", False)), data))
+
+
+class _Replayer(object):
+    """
+    Stand-in for one domain of the py-quantaq client that serves recorded responses.
+    """
+    def __init__(self, replay_client, path_for):
+        self.replay_client = replay_client
+        self.path_for = path_for
+
+    def list(self, **kwargs):
+        return self.replay_client._serve(self.path_for(kwargs))
+
+
+class ReplayClient(object):
+    """
+    Serves recorded QuantAQ responses with the same interface as the py-quantaq client, with optional latency and
+    failure injection. Failures are drawn from a seeded random generator, so a run can be repeated exactly.
+    """
+    def __init__(self, fixture_dir, latency=0.0, failure_rate=0.0, seed=0):
+        """
+        :param fixture_dir: (str) folder the responses were recorded in
+        :param latency: (optional float) seconds every request takes
+        :param failure_rate: (optional float) probability (0 to 1) that a request fails with a ReplayError
+        :param seed: (optional int) seed for the failure injection
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.devices = _Replayer(self, lambda kwargs: _devices_path(fixture_dir))
+        self.data = _Replayer(self, lambda kwargs: _data_path(
+            fixture_dir, kwargs["sn"], kwargs["start"], kwargs["stop"], kwargs.get("raw", False)))
+
+    def _serve(self, path):
+        time.sleep(self.latency)
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+        if failed:
+            raise ReplayError(f"injected failure for {path}")
+        if not os.path.exists(path):
+            raise ReplayError(f"no recorded response at {path}")
+        with open(path, "r") as f:
+            return json.load(f)
+
+
+class ReplayServer(object):
+    """
+    Local HTTP server that replays recorded IEM responses. Point iem.SERVICE at service_url to use it.
+    Injected failures are answered with HTTP 503, like IEM does when it throttles requests.
+    """
+    def __init__(self, fixture_dir, latency=0.0, failure_rate=0.0, seed=0, port=0):
+        """
+        :param fixture_dir: (str) folder the responses were recorded in
+        :param latency: (optional float) seconds every request takes
+        :param failure_rate: (optional float) probability (0 to 1) that a request fails
+        :param seed: (optional int) seed for the failure injection
+        :param port: (optional int) port to listen on, by default a free port is picked
+        """
+        rng, lock = random.Random(seed), threading.Lock()
+        self.stats = {"requests": 0, "failures": 0}
+        stats = self.stats
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency)
+                with lock:
+                    stats["requests"] += 1
+                    failed = rng.random() < failure_rate
+                    stats["failures"] += failed
+                path = iem_fixture_path(fixture_dir, parse.urlsplit(self.path).query)
+                if failed or not os.path.exists(path):
+                    self.send_error(503 if failed else 404)
+                    return
+                with open(path, "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.service_url = f"http://127.0.0.1:{self.server.server_address[1]}/asos.py?"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def bench(fixture_dir, sensors, start, end, workers=(1, 4), latency=0.5, failure_rate=0.0):
+    """
+    Time downloading recorded sensor data and IEM data through the replay stand-ins.
+
+    :param fixture_dir: (str) folder the responses were recorded in
+    :param sensors: (list of str) serial numbers of recorded sensors
+    :param start: (datetime) beginning of the recorded date range
+    :param end: (datetime) end of the recorded date range
+    :param workers: (optional tuple of int) numbers of concurrent sensor downloads to compare
+    :param latency: (optional float) seconds every replayed request takes
+    :param failure_rate: (optional float) probability that a replayed request fails
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import data_analysis.iem as iem
+    from data_analysis.quantaq_pipeline import QuantAQHandler
+
+    for n in workers:
+        client = ReplayClient(fixture_dir, latency=latency, failure_rate=failure_rate)
+        handler = QuantAQHandler(None, cache_dir=None, client=client)
+        s = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            results = list(pool.map(lambda sn: _try(handler.request_data, sn, start, end), sensors))
+        failed = sum(r is None for r in results)
+        print(f"QuantAQ, {n} worker(s): {time.perf_counter() - s:.1f}s, {failed} of {len(sensors)} sensors failed")
+
+    with ReplayServer(fixture_dir, latency=latency, failure_rate=failure_rate) as server:
+        service, cache_dir = iem.SERVICE, iem.CACHE_DIR
+        iem.SERVICE, iem.CACHE_DIR = server.service_url, os.path.join(fixture_dir, "bench_iem_cache")
+        try:
+            s = time.perf_counter()
+            iem.fetch_data(start, end)
+            print(f"IEM: {time.perf_counter() - s:.1f}s, {server.stats}")
+        finally:
+            iem.SERVICE, iem.CACHE_DIR = service, cache_dir
+
+
+def _try(func, *args):
+    try:
+        return func(*args)
+    except Exception as exp:
+        print(exp)
+        return None
+
+
+if __name__ == "__main__":
+    # python3 -m data_analysis.replay <fixture_dir> <start YYYY-MM-DD> <end YYYY-MM-DD> <sn> [<sn> ...]
+    from datetime import datetime
+    bench(sys.argv[1], sys.argv[4:], datetime.fromisoformat(sys.argv[2]), datetime.fromisoformat(sys.argv[3]))
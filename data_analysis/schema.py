@@ -0,0 +1,112 @@
+"""
+Project: Air Partners
+Description: Canonical in-memory format of cleaned sensor data
+
+Cleaned sensor dataframes store measurements as float32 and the sensor serial number and model as categories.
+The location of a sensor does not change within a dataframe, so instead of a 'geo' dictionary on every row it is
+stored once, as df.attrs['geo'] = {'lat': ..., 'lon': ...}.
+
+Dataframes handed to the visualizers are also normalized: indexed by a sorted, unique, timezone-aware local
+DatetimeIndex, flagged with df.attrs['normalized'] = True, so plots never have to parse or sort timestamps.
+"""
+import numpy as np
+import pandas as pd
+
+# dtype used for all measurement columns
+MEASUREMENT_DTYPE = np.float32
+# columns with only a handful of distinct values
+CATEGORY_COLS = ["sn", "model"]
+# timezone of the sensors, plots show local time
+LOCAL_TZ = "US/Eastern"
+# name of the local time index of normalized dataframes
+LOCAL_INDEX = "local_time"
+
+
+def compact(df):
+    """
+    Convert a cleaned dataframe to the canonical compact format. Converting a dataframe that is already compact
+    does nothing, so this can be called again after combining dataframes.
+
+    :param df: (pd.DataFrame) cleaned sensor data
+    :returns: compact copy of df
+    """
+    attrs = dict(df.attrs)
+    if 'geo' in df:
+        location = _last_location(df['geo'])
+        if location is not None:
+            attrs['geo'] = location
+        df = df.drop(columns=['geo'])
+
+    dtypes = {c: MEASUREMENT_DTYPE for c in df.columns if df[c].dtype == np.float64}
+    dtypes.update({c: 'category' for c in CATEGORY_COLS if c in df and df[c].dtype != 'category'})
+    df = df.astype(dtypes)
+    df.attrs = attrs
+    return df
+
+
+def _last_location(geo):
+    """
+    Get the most recent location from a column of 'geo' dictionaries.
+
+    :param geo: (pd.Series) column of {'lat': ..., 'lon': ...} dictionaries
+    :returns: dictionary with 'lat' and 'lon' keys, or None if no row has a location
+    """
+    for value in reversed(geo.tolist()):
+        if isinstance(value, dict) and value.get('lat') is not None and value.get('lon') is not None:
+            return {'lat': float(value['lat']), 'lon': float(value['lon'])}
+    return None
+
+
+def get_location(df):
+    """
+    Get the location of the sensor a dataframe came from. Works for compact dataframes and for dataframes stored
+    by older versions of the pipeline, which still have a 'geo' column.
+
+    :param df: (pd.DataFrame) cleaned sensor data
+    :returns: dictionary with 'lat' and 'lon' keys, or None if the location is unknown
+    """
+    if 'geo' in df.attrs:
+        return df.attrs['geo']
+    if 'geo' in df:
+        return _last_location(df['geo'])
+    return None
+
+
+def is_normalized(df):
+    """
+    :param df: (pd.DataFrame) sensor data
+    :returns: True if df was normalized by normalize and not re-indexed since
+    """
+    return bool(df.attrs.get('normalized')) and isinstance(df.index, pd.DatetimeIndex)
+
+
+def normalize(df):
+    """
+    Index a dataframe by local time: the 'timestamp' column (UTC, timezone-naive timestamps are treated as UTC) is
+    parsed if needed and converted to a sorted, unique, timezone-aware LOCAL_TZ index. The 'timestamp' column is kept.
+    Normalizing a normalized dataframe does nothing, so this is cheap to call before every plot.
+
+    :param df: (pd.DataFrame) sensor data with a 'timestamp' column
+    :returns: normalized dataframe, flagged with df.attrs['normalized']
+    """
+    if is_normalized(df):
+        return df
+    attrs = dict(df.attrs)
+
+    timestamps = df['timestamp']
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps)
+        df = df.assign(timestamp=timestamps)
+    local = timestamps.dt.tz_localize('UTC') if timestamps.dt.tz is None else timestamps
+    df = df.set_axis(pd.DatetimeIndex(local.dt.tz_convert(LOCAL_TZ), name=LOCAL_INDEX), axis=0)
+
+    if df.index.hasnans:
+        df = df.loc[df.index.notna()]
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+    if not df.index.is_unique:
+        df = df.loc[~df.index.duplicated(keep='last')]
+
+    attrs['normalized'] = True
+    df.attrs = attrs
+    return df
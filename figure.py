@@ -77,7 +77,7 @@ def create_singular_figure(year, month, plot_function, sensor, pm):
         start_date, end_date = _get_start_end_dates(2022, 6)
         mod_handler = qp.ModPMHandler(start_date=start_date, end_date=end_date)
 
-        df = mod_handler.load_df(sensor, start_date, end_date)
+        df = mod_handler.load_df(sensor, start_date, end_date, columns=PLOT_COLUMNS)
 
         plot_function(df, pm, month, year)
         plt.show()
@@ -4,20 +4,39 @@ Project: Air Partners
 
 Script for importing necessary data for air quality analysis for static reporting.
 """
+import os
 import sys
+import time
+import traceback
 import pandas as pd
 from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import quantaq
-from quantaq.utils import to_dataframe
 from datetime import datetime
 import data_analysis.quantaq_pipeline as qp
+import data_analysis.iem as iem
+from data_analysis.replay import ReplayClient, RecordingClient
+from data_analysis.schema import normalize
+from data_analysis.registry import get_registry
 from pull_from_drive import pull_sensor_install_data
 from utils.create_maps import main
+from utils.deployment_timeline import load_timeline
 
-with open('quantaq_token.txt', 'r') as f:
-    token = f.read()
+# the QuantAQ API can be replaced by recorded responses, see data_analysis/replay.py
+if os.environ.get('QUANTAQ_REPLAY_DIR'):
+    client = ReplayClient(os.environ['QUANTAQ_REPLAY_DIR'])
+else:
+    with open('quantaq_token.txt', 'r') as f:
+        token = f.read()
 
-client = quantaq.QuantAQAPIClient(token)
+    client = quantaq.QuantAQAPIClient(token)
+    if os.environ.get('QUANTAQ_RECORD_DIR'):
+        client = RecordingClient(client, os.environ['QUANTAQ_RECORD_DIR'])
+
+# city filter of the Roxbury sensors, in the syntax of the QuantAQ API's "like" filter
+ROXBURY_CITY = '%_oxbury%'
+# where pull_sensor_install_data saves the sensor installation notes
+INSTALL_DATA_PATH = 'sensor_install_data.csv'
 
 
 class DataImporter(object):
@@ -34,32 +53,31 @@ class DataImporter(object):
         self.year = year
         self.month = month
         self.install_data = None  # initialize to None
+        self.timeline = None  # deployment timeline, built from install_data when first needed
+        self.fetch_report = {}  # per-sensor download summary, filled by get_PM_data
+        self.fetch_errors = {}  # error of every sensor whose data could not be got, filled by _fetch_sensor
 
 
     def get_all_sensor_list(self):
         """
         Gets the list of sensors currently within Roxbury QuantAQ database.
-        Retrieves a list of sensor names from QuantAQ API.
+        Sensor metadata comes from the sensor registry, which is refreshed from the QuantAQ API once per run.
 
-        :returns: A filtered list of sensor information
-        :returns: A list of all sensor information
+        :returns: A list of serial numbers of all Roxbury sensors
         """
-        devices_raw = to_dataframe(
-            client.devices.list(filter="city,like,%_oxbury%"))
-        devices_simplified = devices_raw.iloc[:, [
-            4, 3, 11, 15, 16, 5, 7, 8, 10, 12]]
-        
-        return devices_simplified, devices_raw
+        return get_registry(client).serials(city=ROXBURY_CITY)
 
-    def _get_install_data(self):
+    def _get_install_data(self, pull=True):
         """
         Pull sensor installation notes from google drive and modifies dataframe for ease of use.
 
+        :param pull: (optional bool) if False, the notes already saved at INSTALL_DATA_PATH are read without pulling them
         :returns: a dataframe of sensor install data
         """
         if self.install_data is None:
-            pull_sensor_install_data()
-            df = pd.read_csv('sensor_install_data.csv')
+            if pull:
+                pull_sensor_install_data()
+            df = pd.read_csv(INSTALL_DATA_PATH)
             print(df)
             df = df[["Timestamp", "Select action", "Sensor serial number (SN)", "Date", "Time",
                  "Location site", "Is the sensor being installed indoors or outdoors?"]]
@@ -74,49 +92,60 @@ class DataImporter(object):
 
         return self.install_data
 
+    def _get_timeline(self):
+        """
+        Get the deployment timeline of all sensors. The timeline is cached next to the install notes and only
+        rebuilt when the notes change.
+
+        :returns: a DeploymentTimeline
+        """
+        if self.timeline is None:
+            # pull the latest install notes before checking the cached timeline against them; they are only
+            # parsed if the cached timeline is out of date
+            pull_sensor_install_data()
+            self.timeline = load_timeline(INSTALL_DATA_PATH, lambda: self._get_install_data(pull=False))
+        return self.timeline
+
     def get_installed_sensor_list(self):
         """
         Pull sensor installation notes from google drive and create list of all sensors with data for the given month.
 
-        :returns: a list of serial numbers for all sensors that were installed that month
+        :returns: a list of serial numbers for all sensors that were installed outdoors at any time that month
         """
         start_date, end_date = self._get_start_end_dates(self.year, self.month)
 
-        df = self._get_install_data()
-
-        active_sensors = []
-
-        for row in df.itertuples():
-            if (row.sn not in active_sensors and row.action == 'installation' and pd.to_datetime(row.Date) < end_date
-                    and row.indoors_outdoors == 'Outdoors'):
-                active_sensors.append(row.sn)
-            elif (row.sn in active_sensors and row.action == 'removal' and pd.to_datetime(row.Date) < start_date):
-                active_sensors.remove(row.sn)
+        return self._get_timeline().active_sensors(start_date, end_date, outdoors_only=True)
 
-        return active_sensors
-
-    def _data_month(self, sensor_sn):
+    def _data_month(self, sensor_sn, columns=None):
         """
         Gets data for a specific sensor.
-        If data doesn't already exist in a pickle file, data is pulled from QuantAQ API.
+        If data doesn't already exist in a stored file, data is pulled from QuantAQ API.
 
         :param sensor_sn: (str) The serial number of the sensor to pull data for
+        :param columns: (optional list of str) if included, only these columns are returned
         :returns: A pandas dataframe containing all of the sensor data for the month
         """
         start_date, end_date = self._get_start_end_dates(self.year, self.month)
         # instantiate handler used to download data
         mod_handler = qp.ModPMHandler(start_date=start_date, end_date=end_date)
+        # timestamps are always needed to filter the data by installation dates
+        if columns is not None and 'timestamp' not in columns:
+            columns = ['timestamp'] + list(columns)
 
         try:
-            # Try to load data from a pickle file first
-            df = mod_handler.load_df(sensor_sn, start_date, end_date)
-            print("\r Data pulled from Pickle file", flush=True)
-        except:
+            # Try to load data from a stored file first
+            df = mod_handler.load_df(sensor_sn, start_date, end_date, columns=columns)
+            print("\r Data pulled from stored file", flush=True)
+        except (OSError, ValueError):
+            # no stored file, or one that can't be read
             try:
-                # Pull dataframe from API, will return the dataframe and save it as a pickle file
+                # Pull dataframe from API, will return the dataframe and store it locally
                 df = mod_handler.from_api(sensor_sn)
-            except:
-                # If there is a request protocol error, return an empty dataframe (temp solution)
+            except (qp.DownloadError,) + qp.DOWNLOAD_ERRORS as exp:
+                # If the download failed, return an empty dataframe and report the sensor as failed.
+                # Chunks that did download are cached, so running the import again resumes where it stopped.
+                print(f"{sensor_sn}: download failed with {exp}")
+                self.fetch_errors[sensor_sn] = str(exp)
                 return pd.DataFrame()
 
         # If dataframe comes back empty, return it
@@ -125,21 +154,12 @@ class DataImporter(object):
             return df
 
         # Only get rows of the DataFrame between the installation and removal dates of the sensor
-        install_df = self._get_install_data()
-        install_df = install_df.loc[install_df['sn'] == sensor_sn]\
-        # Create a mask for each installation and removal date of the sensor
-        mask = pd.Series(False, index=df.index)
-        for row in install_df.itertuples():
-            when = pd.to_datetime(row.Date + ' ' + row.Time)
-            if when > start_date and when < end_date:
-                if row.action == 'installation':
-                    mask |= (df['timestamp'] > when)
-                elif row.action == 'removal':
-                    mask |= (df['timestamp'] < when)
-        # Filter the DataFrame based on the created mask
-        df = df.loc[mask]
-
-        return df
+        df = df.loc[self._get_timeline().mask(sensor_sn, df['timestamp'])]
+        if columns is not None:
+            df = df[columns]
+
+        # index by sorted, unique local time once here, so the plots don't have to
+        return normalize(df)
 
     def _get_start_end_dates(self, year_int_YYYY, month_int):
         """
@@ -163,10 +183,52 @@ class DataImporter(object):
         end_date = datetime(next_year, next_month, 1)
         return start_date, end_date
 
-    def get_PM_data(self):
+    def _fetch_sensor(self, sn, columns=None):
+        """
+        Gets the data of one sensor for get_PM_data. Any error is recorded in self.fetch_errors instead of stopping
+        the download of the other sensors.
+
+        :param sn: (str) The serial number of the sensor to pull data for
+        :param columns: (optional list of str) if included, only these columns are returned
+        :returns: A pandas dataframe containing the sensor data, empty if getting it failed
+        """
+        try:
+            return self._data_month(sn, columns=columns)
+        except Exception:
+            # e.g. malformed data or a failed write; keep the traceback for the fetch report
+            self.fetch_errors[sn] = traceback.format_exc()
+            print(f"{sn}: failed with\n{self.fetch_errors[sn]}", flush=True)
+            return pd.DataFrame()
+
+    def _fetch_report_entry(self, sn, df, started):
+        """
+        Summarizes the outcome of downloading one sensor's data.
+
+        :param sn: (str) serial number of the sensor
+        :param df: (pd.DataFrame) dataframe returned by _data_month
+        :param started: (float) time.monotonic() value from when the download started
+        :returns: dictionary with the status ('ok', 'empty' or 'failed'), number of rows and duration of the
+                  download, and the error if it failed
+        """
+        entry = {
+            'status': 'failed' if sn in self.fetch_errors else 'empty' if df.empty else 'ok',
+            'rows': len(df),
+            'seconds': round(time.monotonic() - started, 1),
+        }
+        if sn in self.fetch_errors:
+            entry['error'] = self.fetch_errors[sn]
+        return entry
+
+    def get_PM_data(self, max_workers=1, columns=None):
         """
         Collects data from all sensors for the month.
 
+        Sensors can be downloaded concurrently by setting max_workers above 1. Each download mostly waits
+        on the QuantAQ API, so a handful of threads cuts the total download time roughly by the worker count.
+        A per-sensor summary of every download is stored in self.fetch_report.
+
+        :param max_workers: (optional int) number of sensors to download at the same time
+        :param columns: (optional list of str) if included, only these columns are loaded for each sensor
         :returns: A list of all sensors available from QuantAQ API
         :returns: A dictionary of sensor serial number keys and pandas dataframes containing sensor data
         """
@@ -176,31 +238,96 @@ class DataImporter(object):
         except:
             sn_list = self.get_all_sensor_list()
         sn_dict = {}
+        self.fetch_report = {}
+        self.fetch_errors = {}
+        # refresh sensor metadata (locations for picking weather stations, maps) once for the whole run
+        registry = get_registry(client)
+        # download the weather data of the stations of all sensors that have to be pulled from the API together,
+        # once, so they are served from the cache. Sensors with a stored month already have their weather data
+        start_date, end_date = self._get_start_end_dates(self.year, self.month)
+        mod_handler = qp.ModPMHandler(start_date=start_date, end_date=end_date)
+        missing = [sn for sn in sn_list if not mod_handler.has_df(sn)]
+        if missing:
+            iem.prefetch(start_date, end_date, {iem.station_for(sn, registry.location(sn)) for sn in missing})
 
         #  modify to meet manny's need
         sn_count = len(sn_list)
 
-        sensor_count = 1
-        # For every sensor, download DataFrame with data of that sensor and insert it into dictionary
-        for sn in sn_list:
-            # Print out sensor downloading progress
-            print(
-                '\rSensor Progress: {0} / {1}\n'.format(sensor_count, sn_count), end='', flush=True)
-            # If sensor data already exists in pickle file, use that
-            df = self._data_month(sn)
-            print('checking data')
-            # print(df)
-            # Add new dataframe to dictionary
-            sn_dict[sn] = df
-            sensor_count += 1
+        if max_workers <= 1:
+            sensor_count = 1
+            # For every sensor, download DataFrame with data of that sensor and insert it into dictionary
+            for sn in sn_list:
+                # Print out sensor downloading progress
+                print(
+                    '\rSensor Progress: {0} / {1}\n'.format(sensor_count, sn_count), end='', flush=True)
+                started = time.monotonic()
+                # If sensor data already exists in pickle file, use that
+                df = self._fetch_sensor(sn, columns=columns)
+                print('checking data')
+                # print(df)
+                # Add new dataframe to dictionary
+                sn_dict[sn] = df
+                self.fetch_report[sn] = self._fetch_report_entry(sn, df, started)
+                sensor_count += 1
+        else:
+            # load the deployment timeline once up front so worker threads don't each pull the install notes
+            try:
+                self._get_timeline()
+            except Exception as exp:
+                print(f"could not load the deployment timeline: {exp}")
+
+            def fetch(sn):
+                started = time.monotonic()
+                return sn, self._fetch_sensor(sn, columns=columns), started
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(fetch, sn) for sn in sn_list]
+                for sensor_count, future in enumerate(as_completed(futures), start=1):
+                    sn, df, started = future.result()
+                    sn_dict[sn] = df
+                    self.fetch_report[sn] = self._fetch_report_entry(sn, df, started)
+                    print('Sensor Progress: {0} / {1} ({2}: {3}, {4} rows, {5}s)'.format(
+                        sensor_count, sn_count, sn, self.fetch_report[sn]['status'],
+                        self.fetch_report[sn]['rows'], self.fetch_report[sn]['seconds']), flush=True)
+            # keep the same sensor order as the serial download
+            sn_dict = {sn: sn_dict[sn] for sn in sn_list}
         print('\nDone!')
-        
+        print('IEM weather cache: {hits} days cached, {misses} days downloaded in {requests} requests'.format(**iem.CACHE_STATS))
+
         return sn_list, sn_dict
 
+    def update_PM_data(self):
+        """
+        Incrementally updates the stored data of every installed sensor for the month with the data that arrived
+        since the last update. Run daily so that get_PM_data at the end of the month only reads local files.
+
+        :returns: A dictionary of sensor serial number keys and the number of rows stored for that sensor
+        """
+        start_date, end_date = self._get_start_end_dates(self.year, self.month)
+        try:
+            sn_list = self.get_installed_sensor_list()
+        except:
+            sn_list = self.get_all_sensor_list()
+
+        rows = {}
+        for sensor_count, sn in enumerate(sn_list, start=1):
+            print('Sensor Progress: {0} / {1}'.format(sensor_count, len(sn_list)), flush=True)
+            mod_handler = qp.ModPMHandler(start_date=start_date, end_date=end_date)
+            try:
+                df = mod_handler.update_from_api(sn)
+            except Exception as exp:
+                # Leave the stored data as it is, the next update picks up from the same point
+                print(f"{sn}: update failed with {exp}")
+                continue
+            rows[sn] = 0 if df is None else len(df)
+        return rows
+
 
 if __name__ == '__main__':
     (year, month) = (sys.argv[1], sys.argv[2])
+    # optional third argument sets how many sensors are downloaded at the same time
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
     di = DataImporter(year=int(year), month=int(month))
-    sn_list, sn_dict = di.get_PM_data()
+    sn_list, sn_dict = di.get_PM_data(max_workers=workers)
     print(sn_list, sn_dict)
     main(sn_list, sn_dict)
@@ -0,0 +1,40 @@
+"""
+Project: Air Partners
+
+Script for incrementally downloading sensor data during the month, so that the monthly
+report run only has to read data that is already stored locally. Meant to be run once a
+day (e.g. from cron). To run from command line:
+
+        $ python3 ingest.py [<YEAR> <MONTH>]
+
+If <YEAR> and <MONTH> are left out, the current month is updated. On the first day of a
+month the previous month is updated as well, so its last day is not missed.
+"""
+import sys
+from datetime import datetime, timedelta
+from import_data import DataImporter
+
+
+def ingest(year, month):
+    """
+    Appends newly arrived data for every installed sensor to the stored data of the month.
+
+    :param year: (int) year of the month to update
+    :param month: (int) month to update
+    """
+    print(f"Updating {year}-{month:02d}")
+    di = DataImporter(year=year, month=month)
+    rows = di.update_PM_data()
+    for sn, n in rows.items():
+        print(f"{sn}: {n} rows stored")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        ingest(int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        today = datetime.utcnow()
+        if today.day == 1:
+            yesterday = today - timedelta(days=1)
+            ingest(yesterday.year, yesterday.month)
+        ingest(today.year, today.month)
@@ -22,8 +22,8 @@ year=$(date '+%Y')
 
 echo "Date": $year-$month
 
-# import data
-python3 import_data.py $year $month
+# import data (last argument is the number of sensors downloaded at the same time)
+python3 import_data.py $year $month 4
 sleep 5
 
 # create plots
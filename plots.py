@@ -14,46 +14,34 @@ import data_analysis.quantaq_pipeline as qp
 from datetime import datetime
 
 
-# STATICS
-YEAR = int(sys.argv[1])
-MONTH = int(sys.argv[2])
-
-# Import sensor data
-di = DataImporter(year=YEAR, month=MONTH)
-sn_list, sn_dict = di.get_PM_data()
-
-
-# create date string for data storage
-date_str = str(YEAR) + '-0' + str(MONTH) if MONTH<=9 else str(YEAR) + '-' + str(MONTH)
-
-# plot graphs
-pl = Plotter(date_str, sn_list, sn_dict)
-
-# calendar plots
-pl.plot_and_export(calendar_plot, pm='pm1', month=MONTH, year=YEAR)
-pl.plot_and_export(calendar_plot, pm='pm25',month=MONTH, year=YEAR)
-pl.plot_and_export(calendar_plot, pm='pm10',month=MONTH, year=YEAR)
-print('Calendars plotted')
-plt.close()
-
-# timeplots with thresholds
-pl.plot_and_export(timeplot_threshold, pm=None)
-print('Timelines plotted')
-plt.close()
-
-# diurnal plots
-pl.plot_and_export(diurnal_plot, pm='pm1', weekday=True)
-pl.plot_and_export(diurnal_plot, pm='pm25',weekday=True)
-pl.plot_and_export(diurnal_plot, pm='pm10',weekday=True)
-pl.plot_and_export(diurnal_plot, pm='pm1', weekday=False)
-pl.plot_and_export(diurnal_plot, pm='pm25',weekday=False)
-pl.plot_and_export(diurnal_plot, pm='pm10',weekday=False)
-print('Diurnals plotted')
-plt.close()
-
-# wind polar plots (computationally expensive)
-pl.plot_and_export(wind_polar_plot, pm='pm1')
-pl.plot_and_export(wind_polar_plot, pm='pm25')
-pl.plot_and_export(wind_polar_plot, pm='pm10')
-print('Wind polar plots plotted')
-plt.close()
+# Figures made for every sensor: (plot function, pm, keyword arguments)
+def report_figures(month, year):
+    return [(calendar_plot, pm, dict(month=month, year=year)) for pm in ['pm1', 'pm25', 'pm10']] + \
+        [(timeplot_threshold, None, {})] + \
+        [(diurnal_plot, pm, dict(weekday=weekday)) for weekday in [True, False] for pm in ['pm1', 'pm25', 'pm10']] + \
+        [(wind_polar_plot, pm, {}) for pm in ['pm1', 'pm25', 'pm10']]  # wind polar plots are computationally expensive
+
+
+# figures are rendered in worker processes, so only run the pipeline when this file is run as a script
+if __name__ == '__main__':
+    # STATICS
+    YEAR = int(sys.argv[1])
+    MONTH = int(sys.argv[2])
+    # optional third argument sets how many figures are rendered at the same time (defaults to the number of CPUs)
+    WORKERS = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    # Import sensor data
+    di = DataImporter(year=YEAR, month=MONTH)
+    sn_list, sn_dict = di.get_PM_data(columns=PLOT_COLUMNS)
+
+    # create date string for data storage
+    date_str = str(YEAR) + '-0' + str(MONTH) if MONTH<=9 else str(YEAR) + '-' + str(MONTH)
+
+    # plot graphs
+    pl = Plotter(date_str, sn_list, sn_dict)
+    results = pl.render_all(report_figures(MONTH, YEAR), max_workers=WORKERS)
+
+    failed = [r for r in results if r['error'] is not None]
+    print('{0} of {1} figures plotted'.format(len(results) - len(failed), len(results)))
+    for r in failed:
+        print('{sn} {figure} {pm}: {error}'.format(**r))
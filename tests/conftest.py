@@ -0,0 +1,9 @@
+"""
+Project: Air Partners
+
+The modules are run from the repository root (python3 -m data_analysis...), so the tests import them from there too.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
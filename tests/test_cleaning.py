@@ -0,0 +1,43 @@
+"""
+Project: Air Partners
+
+The cleaning kernel (DataHandler._clean_kernel, behind flags and _cutoffs) has to give exactly the same output as the
+per-column flags/_cutoffs implementation it replaced, which is kept in data_analysis/bench_cleaning.py.
+"""
+import pandas as pd
+import pytest
+
+from data_analysis.bench_cleaning import count_copies, legacy_cutoffs, legacy_flags, make_month
+from data_analysis.quantaq_pipeline import ModPMHandler, SNHandler
+
+# columns the SN handler applies the cutoffs to, see SNHandler._clean_df
+SN_CUTOFF_COLS = ["o3", "co", "no2", "bin0", "pm1", "no"]
+
+
+@pytest.mark.parametrize("smoothed", [True, False])
+def test_mod_pm_kernel_matches_legacy(smoothed):
+    # MOD-PM order: spikes first, then cutoffs
+    handler = ModPMHandler()
+    df = make_month(handler.data_cols)
+    expected = legacy_cutoffs(handler, legacy_flags(handler, df.copy()), smoothed=smoothed)
+    result = handler._clean_kernel(df.copy(), smoothed=smoothed)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize("smoothed", [True, False])
+def test_sn_kernel_matches_legacy(smoothed):
+    # SN order: cutoffs on a subset of columns first, then spikes on all of them
+    handler = SNHandler()
+    df = make_month(handler.data_cols)
+    expected = legacy_flags(handler, legacy_cutoffs(handler, df.copy(), cols=SN_CUTOFF_COLS, smoothed=smoothed))
+    result = handler.flags(handler._cutoffs(df.copy(), cols=SN_CUTOFF_COLS, smoothed=smoothed))
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_kernel_copies_once_per_call():
+    handler = ModPMHandler()
+    df = make_month(handler.data_cols)
+    copies = count_copies(lambda df: handler._clean_kernel(df), df)
+    # one column selection, one NumPy block and one assign, however many columns are cleaned
+    assert copies.total == 3
+    assert count_copies(lambda df: legacy_cutoffs(handler, legacy_flags(handler, df)), df).total > copies.total
@@ -0,0 +1,49 @@
+"""
+Project: Air Partners
+
+An incremental update combines the QC record of the stored input with the record of the new rows, so the combined
+record has to match the record of all the rows computed at once.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_analysis.qc import column_std, combine_reports, quality_report
+
+COLS = ['pm1', 'pm25', 'pm10']
+START, END = pd.Timestamp('2022-06-01'), pd.Timestamp('2022-07-01')
+
+
+def sensor_month():
+    rng = np.random.default_rng(0)
+    times = pd.date_range(START, periods=30000, freq='1min', tz='UTC')
+    data = {c: rng.gamma(2.0, 5.0, len(times)) * (i + 1) for i, c in enumerate(COLS)}
+    data['pm1'][rng.choice(len(times), 300, replace=False)] = np.nan
+    data['pm25'][rng.choice(len(times), 50, replace=False)] *= -1
+    data['pm10'][rng.choice(len(times), 50, replace=False)] = 400
+    return pd.DataFrame({'timestamp': times, **data})
+
+
+def test_combined_report_matches_whole():
+    df = sensor_month()
+    whole = quality_report(df, COLS, 300, START, END)
+    stored = quality_report(df.iloc[:21000], COLS, 300, START, END)
+    new = quality_report(df.iloc[21000:], COLS, 300, START, END)
+    combined = combine_reports(stored, new)
+
+    for key in ['rows', 'expected_rows', 'first', 'last']:
+        assert combined[key] == whole[key]
+    for col in COLS:
+        for key in ['count', 'nan_rate', 'negative_rate', 'zero_rate', 'over_cutoff_rate', 'coverage', 'mean', 'std']:
+            assert combined['columns'][col][key] == pytest.approx(whole['columns'][col][key], rel=1e-9), (col, key)
+    np.testing.assert_allclose(column_std(combined, COLS), df[COLS].std().to_numpy(), rtol=1e-9)
+
+
+def test_combine_with_empty_column():
+    df = sensor_month()
+    df.loc[:9999, 'pm25'] = np.nan
+    combined = combine_reports(quality_report(df.iloc[:10000], COLS, 300, START, END),
+                               quality_report(df.iloc[10000:], COLS, 300, START, END))
+    whole = quality_report(df, COLS, 300, START, END)
+    assert combined['columns']['pm25']['count'] == whole['columns']['pm25']['count']
+    assert combined['columns']['pm25']['std'] == pytest.approx(whole['columns']['pm25']['std'], rel=1e-9)
@@ -0,0 +1,59 @@
+"""
+Project: Air Partners
+
+The registry is refreshed from the unfiltered device list and filtered by city afterwards, so it has to select the
+same sensors as the city filter the QuantAQ API was queried with before ("city,like,%_oxbury%").
+"""
+import pytest
+
+from data_analysis.registry import SensorRegistry, like
+
+ROXBURY_CITY = "%_oxbury%"
+
+# (city, whether filter="city,like,%_oxbury%" returns the device)
+CITIES = [
+    ("Roxbury", True),
+    ("roxbury", True),
+    ("West Roxbury", True),
+    ("Roxbury Crossing", True),
+    ("Roxbury, MA", True),
+    ("Oxbury", False),      # '_' needs a character before "oxbury"
+    ("oxbury", False),
+    ("ROXBURY", False),     # LIKE is case sensitive
+    ("Roxburry", False),
+    ("Boston", False),
+    ("", False),
+    (None, False),
+]
+
+
+def devices():
+    return [
+        {"sn": f"MOD-PM-{i:05d}", "model": "modulair_pm", "city": city, "geo": {"lat": 42.33, "lon": -71.09}}
+        for i, (city, _) in enumerate(CITIES)
+    ]
+
+
+@pytest.mark.parametrize("city, expected", CITIES)
+def test_like_matches_api_filter(city, expected):
+    assert like(ROXBURY_CITY, city) == expected
+
+
+def test_serials_match_api_filter():
+    registry = SensorRegistry.from_devices(devices())
+    expected = sorted(f"MOD-PM-{i:05d}" for i, (_, match) in enumerate(CITIES) if match)
+    assert registry.serials(city=ROXBURY_CITY) == expected
+
+
+def test_like_escapes_regex_characters():
+    assert like("St. Louis%", "St. Louis, MO")
+    assert not like("St. Louis%", "Stx Louis, MO")
+    assert like("100%", "100 Main St")
+
+
+def test_serials_filter_by_model():
+    registry = SensorRegistry.from_devices(devices() + [{"sn": "SN000-001", "model": "arisense_v200",
+                                                         "city": "Roxbury", "geo": {}}])
+    assert "SN000-001" in registry.serials(city=ROXBURY_CITY)
+    assert "SN000-001" not in registry.serials(city=ROXBURY_CITY, model="modulair_pm")
+    assert registry.location("SN000-001") is None
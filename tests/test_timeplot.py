@@ -0,0 +1,77 @@
+"""
+Project: Air Partners
+
+Timeplot panels only draw the points that are visible at the resolution of the report, so a decimated timeplot has
+to look the same as one drawing every reading.
+"""
+import io
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from visualizers.timeplot_thresholds import Timeplot, minmax_indices, DECIMATION_BUCKETS
+
+# resolution the report saves figures at, see utils/create_plots.py
+DPI = 300
+# a pixel differs if any of its channels is off by more than this; smaller differences are anti-aliasing
+CHANNEL_TOLERANCE = 64
+# largest fractions of pixels that may differ by more than CHANNEL_TOLERANCE and by more than twice that
+MAX_DIFFERING = 0.0125
+MAX_DIFFERING_STRONGLY = 0.005
+
+
+def synthetic_month(seed=0):
+    """
+    A month of minute readings with a daily cycle, peaks, removed spikes, a two day and a half hour outage.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2022-06-01', '2022-07-01', freq='1min', tz='UTC', inclusive='left')
+    daily_cycle = 6 + 4 * np.sin(np.arange(len(times)) * 2 * np.pi / 1440)
+    data = pd.DataFrame({'timestamp': times})
+    for pm, scale in [('pm1', 0.6), ('pm25', 1.0), ('pm10', 2.5)]:
+        values = scale * (daily_cycle + rng.gamma(1.5, 1.5, len(times)))
+        values[rng.integers(0, len(times), 40)] *= 8
+        values[rng.integers(0, len(times), 200)] = np.nan
+        data[pm] = values
+    return data.drop(index=list(range(12000, 14880)) + list(range(30000, 30030)))
+
+
+def render(data, decimate):
+    Timeplot(data, decimate=decimate).show()
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format='raw', dpi=DPI)
+    plt.close('all')
+    return np.frombuffer(buffer.getvalue(), dtype=np.uint8).reshape(-1, 4).astype(int)
+
+
+def test_decimated_timeplot_looks_the_same():
+    data = synthetic_month()
+    full, decimated = render(data, False), render(data, True)
+    assert full.shape == decimated.shape
+    difference = np.abs(full - decimated).max(axis=1)
+    assert (difference > CHANNEL_TOLERANCE).mean() < MAX_DIFFERING
+    assert (difference > 2 * CHANNEL_TOLERANCE).mean() < MAX_DIFFERING_STRONGLY
+
+
+def test_decimation_budget_with_many_gaps():
+    rng = np.random.default_rng(1)
+    values = rng.gamma(1.5, 1.5, 200000)
+    # every third reading missing and most readings next to an outage
+    values[::3] = np.nan
+    breaks = rng.random(len(values)) < 0.5
+    indices = minmax_indices(values, DECIMATION_BUCKETS, breaks=breaks)
+    assert len(indices) <= 6 * DECIMATION_BUCKETS + 2
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_decimation_keeps_both_ends_of_a_gap():
+    values = np.random.default_rng(2).gamma(1.5, 1.5, 100000)
+    values[50000:50010] = np.nan
+    breaks = np.zeros(len(values), dtype=bool)
+    breaks[[70000, 70001]] = True
+    indices = set(minmax_indices(values, 1000, breaks=breaks))
+    assert {49999, 50000, 50009, 50010} <= indices
+    assert {69999, 70000, 70001, 70002} <= indices
@@ -8,6 +8,8 @@ Script to create maps for every sensor.
 import os
 import pandas as pd
 import plotly.graph_objects as go
+from data_analysis.schema import get_location
+from data_analysis.registry import get_registry
 
 def _read_token(token_path):
         with open(token_path, 'r') as f:
@@ -21,10 +23,21 @@ def get_lats_and_longs(sn_list, sn_dict):
         sn = sn_list[i]
         if sn_dict[sn].shape == (0,0):
             sn_list.pop(i)   
+    # sensor locations come from the registry; sensors missing from it fall back to their data
+    registry = get_registry()
+    locations = []
+    for sn in list(sn_list):
+        loc = registry.location(sn) or get_location(sn_dict[sn])
+        # sensors without a known location can't be put on a map
+        if loc is None:
+            print(f"{sn}: location unknown, no map is made")
+            sn_list.remove(sn)
+        else:
+            locations.append(loc)
     sn_locs = pd.DataFrame()
     sn_locs['sensor'] = sn_list
-    sn_locs['lats'] = [sn_dict[sn].iloc[-1]['geo']['lat'] for sn in sn_list]
-    sn_locs['longs'] = [sn_dict[sn].iloc[-1]['geo']['lon'] for sn in sn_list]
+    sn_locs['lats'] = [loc['lat'] for loc in locations]
+    sn_locs['longs'] = [loc['lon'] for loc in locations]
     sn_locs = sn_locs.set_index('sensor')
     return sn_locs
 
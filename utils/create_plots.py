@@ -6,15 +6,22 @@ Script for creating and exporting all figures needed for static reporting.
 """
 
 import os
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from visualizers.calendar_plot import CalendarPlot
 from visualizers.timeplot_thresholds import Timeplot
 from visualizers.diurnal_plot import DiurnalPlot
+from visualizers.aggregates import SensorAggregates, aggregates, minute_data
 from data_analysis.dataviz import OpenAirPlots
 
 # Subscripts (for captions and labels)
 SUB = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")
+# Columns of the cleaned sensor data used by the plots below; loading only these saves time and memory
+PLOT_COLUMNS = ['timestamp', 'pm1', 'pm25', 'pm10', 'wind_dir', 'wind_speed']
 
 def calendar_plot(data_PM, pm, month, year):
     # Create calendar plot
@@ -32,8 +39,8 @@ def timeplot_threshold(data_PM):
 def diurnal_plot(dataPM, pm, weekday=False):
     # Create diurnal plot object
     dp = DiurnalPlot(pm)
-    dataPM = dp.process_data(dataPM)
-    dp.show(dataPM, weekday)
+    # statistics of all pollutants are computed once per sensor, see SensorAggregates.diurnal
+    dp.show(dp.profile(aggregates(dataPM)), weekday)
 
 
 # Daily Average Plot scrapped; information displayed on calendar plot instead
@@ -54,18 +61,22 @@ def diurnal_plot(dataPM, pm, weekday=False):
 def wind_polar_plot(data_PM, pm):
     #df = df.rename(columns={"timestamp_local": "date", "wind_speed": "ws", "wind_dir": "wd"})
     #df.wd = df.wd.replace(0.0, 360.0)
-    df = data_PM[['timestamp', 'wind_speed', 'wind_dir', 'pm25', 'pm10', 'pm1']]
+    df = minute_data(data_PM)[['timestamp', 'wind_speed', 'wind_dir', 'pm25', 'pm10', 'pm1']].reset_index(drop=True)
+    # R has no single precision floats, so hand it float64 columns
+    df = df.astype({c: 'float64' for c in ['wind_speed', 'wind_dir', 'pm25', 'pm10', 'pm1']})
     
     # Remove any points where wind data was unavailable. 
     df = df[df.wind_speed != 0]
 
-    # Format the dataPM to be read in R and plot wind data
+    # Format the dataPM to be read in R and plot wind data. Every call gets its own temporary folder for the R image,
+    # so polar plots can be rendered by several processes at the same time
     air_plt = OpenAirPlots()
-    air_plt.polar_plot(df, 'utils/', [pm])
-    #ro.r.polarPlot(dataPM, pollutant = p, main = f"{p.upper()} Polar Plot")
-    
-    # Take current image, save image again using matplotlib
-    img = plt.imread(fname=f'utils/_polar_{pm}.png')
+    with tempfile.TemporaryDirectory() as tmp:
+        air_plt.polar_plot(df, os.path.join(tmp, ''), [pm])
+        #ro.r.polarPlot(dataPM, pollutant = p, main = f"{p.upper()} Polar Plot")
+
+        # Take current image, save image again using matplotlib
+        img = plt.imread(fname=os.path.join(tmp, f'_polar_{pm}.png'))
     plt.figure(frameon=False)
     plt.imshow(img)
     plt.grid(None)
@@ -73,58 +84,154 @@ def wind_polar_plot(data_PM, pm):
     plt.yticks([])
 
 
+def figure_columns(plot_function, pm):
+    """
+    Columns of the minute data a figure needs.
+
+    Args:
+        plot_function: (function) one of the plotting functions above
+        pm: (str or None) type of PM plotted
+    Returns:
+        (list) column names, or None if the figure only needs the sensor's aggregates
+    """
+    if plot_function is timeplot_threshold:
+        return ['timestamp', 'pm1', 'pm25', 'pm10']
+    if plot_function is wind_polar_plot:
+        return ['timestamp', 'wind_speed', 'wind_dir', 'pm25', 'pm10', 'pm1']
+    # calendar and diurnal plots
+    return None
+
+
+def figure_input(plot_function, pm, agg):
+    """
+    Data sent to a worker rendering a figure: the aggregates without the minute data for figures made from the
+    aggregates, otherwise only the minute data columns the figure needs.
+
+    Args:
+        plot_function: (function) one of the plotting functions above
+        pm: (str or None) type of PM plotted
+        agg: (SensorAggregates) aggregates of the sensor
+    Returns:
+        (SensorAggregates or pandas.DataFrame)
+    """
+    columns = figure_columns(plot_function, pm)
+    if columns is None:
+        return agg.summary()
+    return agg.data[columns]
+
+
+def _render_job(plot_function, df, pm, kwargs, path):
+    """
+    Render one figure and save it, in a worker process.
+
+    Returns:
+        (str or None) error message if the figure failed, None otherwise
+    """
+    matplotlib.use('Agg')
+    try:
+        if pm is None:
+            plot_function(df, **kwargs)
+        else:
+            plot_function(df, pm, **kwargs)
+        plt.savefig(path, bbox_inches='tight', dpi=300)
+        return None
+    except Exception as exp:
+        return f'{type(exp).__name__}: {exp}'
+    finally:
+        plt.close('all')
+
+
 class Plotter(object):
 
     def __init__(self, year_month, sn_list, sn_dict):
         self.year_month = year_month
         self.sn_list = sn_list
         self.sn_dict = sn_dict
+        self.aggregates = {}  # per-sensor SensorAggregates, computed when first needed
         print('debugging')
         print(sn_dict)
 
+    def _aggregates(self, sn):
+        """
+        Get the aggregates of a sensor, computed once and shared by all figures of the sensor.
+
+        Args:
+            sn: (str) serial number of the sensor
+        Returns:
+            (SensorAggregates)
+        """
+        if sn not in self.aggregates:
+            self.aggregates[sn] = SensorAggregates(self.sn_dict[sn])
+        return self.aggregates[sn]
+
+    def _figure_path(self, plot_function, sn, pm, kwargs):
+        """
+        Get the path a figure is saved to, creating its folder if needed. Timeplots include all three pollutants,
+        so they have no pollutant folder; diurnal plots have separate folders for weekdays and weekends.
+
+        Args:
+            plot_function: (function) one of the plotting functions above
+            sn: (str) serial number of the sensor
+            pm: (str or None) type of PM plotted
+            kwargs: (dict) keyword arguments of the plotting function
+        Returns:
+            (str) path of the jpeg file
+        """
+        name = plot_function.__name__
+        folder = '{0}/Graphs/{1}'.format(self.year_month, name)
+        if pm is not None:
+            folder += '/' + pm
+            if 'weekday' in kwargs:
+                folder += '/weekday' if kwargs.get('weekday') else '/weekend'
+        os.makedirs(folder, exist_ok=True)
+        return '{0}/{1}_{2}_{3}.jpeg'.format(folder, sn, self.year_month, name)
+
     def plot_and_export(self, plot_function, pm, **kwargs):
-        try:
-            os.mkdir('{}'.format(self.year_month))
-        except:
-            pass
-        try:
-            os.mkdir('{}/Graphs/'.format(self.year_month))
-        except: 
-            pass
-        try:
-            os.mkdir('{}/Graphs/'.format(self.year_month)+str(plot_function.__name__))
-        except: # Forgive my crime here, but it just avoids errors if the directory already exists
-            pass
-        # make directories for pollutants for graphs that are not timeplot graphs, which already plots for all 3 pollutants
-        if str(plot_function.__name__)!='timeplot_threshold':
-            try:
-                os.mkdir('{0}/Graphs/{1}/{2}'.format(self.year_month, str(plot_function.__name__), pm))
-            except: # Forgive my crime here, but it just avoids errors if the directory already exists
-                pass
-        # make directories for diurnals for weekdays and weekends
-        if str(plot_function.__name__)=='diurnal_plot':
-            try:
-                os.mkdir('{0}/Graphs/{1}/{2}/weekday'.format(self.year_month, str(plot_function.__name__), pm))
-                os.mkdir('{0}/Graphs/{1}/{2}/weekend'.format(self.year_month, str(plot_function.__name__), pm))
-            except:
-                pass
         for sn in self.sn_list:
             if not self.sn_dict[sn].empty:
+                path = self._figure_path(plot_function, sn, pm, kwargs)
                 if pm == None:
-                    plot_function(self.sn_dict[sn], **kwargs)
-                    plt.savefig('{1}/Graphs/{2}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__)), bbox_inches='tight',dpi = 300)
-                ### 
-                ### TODO: this function needs refactoring since directory structures for each plot is very different
-                ###
-                elif 'weekday' in kwargs:
-                    plot_function(self.sn_dict[sn], pm, **kwargs)
-                    if kwargs.get('weekday'):
-                        plt.savefig('{1}/Graphs/{2}/{3}/weekday/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__), pm), bbox_inches='tight',dpi = 300)
-                        #print("Finished {1}/Graphs/{2}/{3}/weekday/{0}_{1}_{2}.jpeg".format(sn, self.year_month, str(plot_function.__name__), pm))
-                    else:
-                        plt.savefig('{1}/Graphs/{2}/{3}/weekend/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__), pm), bbox_inches='tight',dpi = 300)
-                        #print("Finished {1}/Graphs/{2}/{3}/weekend/{0}_{1}_{2}.jpeg".format(sn, self.year_month, str(plot_function.__name__), pm))
+                    plot_function(self._aggregates(sn), **kwargs)
                 else:
-                    plot_function(self.sn_dict[sn], pm, **kwargs)
-                    plt.savefig('{1}/Graphs/{2}/{3}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__), pm), bbox_inches='tight',dpi = 300)
-                plt.close()
\ No newline at end of file
+                    plot_function(self._aggregates(sn), pm, **kwargs)
+                plt.savefig(path, bbox_inches='tight',dpi = 300)
+                plt.close()
+
+    def render_all(self, figures, max_workers=None):
+        """
+        Render every (sensor, figure) pair in a pool of processes. The aggregates of every sensor are computed once
+        here, and each job is only sent the aggregates or columns its figure needs (see figure_input). A failed
+        figure doesn't stop the others; failures are reported in the returned list.
+
+        Args:
+            figures: (list) (plot_function, pm, kwargs) tuples, like the arguments of plot_and_export
+            max_workers: (int) number of processes, defaults to the number of CPUs. With 1, figures are rendered
+                in this process
+        Returns:
+            (list) one dictionary per job with the sensor, figure, pm, path and error (None if it succeeded)
+        """
+        jobs = []
+        for plot_function, pm, kwargs in figures:
+            for sn in self.sn_list:
+                if not self.sn_dict[sn].empty:
+                    path = self._figure_path(plot_function, sn, pm, kwargs)
+                    data = figure_input(plot_function, pm, self._aggregates(sn))
+                    jobs.append((sn, (plot_function, data, pm, kwargs, path)))
+
+        if max_workers == 1:
+            errors = [_render_job(*args) for _, args in jobs]
+        else:
+            # R (used by the polar plots) can't be forked safely, so start fresh worker processes
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+                futures = [pool.submit(_render_job, *args) for _, args in jobs]
+                errors = []
+                for future in futures:
+                    try:
+                        errors.append(future.result())
+                    except Exception as exp:
+                        # the worker itself failed, e.g. it ran out of memory
+                        errors.append(f'{type(exp).__name__}: {exp}')
+
+        return [{'sn': sn, 'figure': args[0].__name__, 'pm': args[2], 'path': args[4], 'error': error}
+                for (sn, args), error in zip(jobs, errors)]
@@ -0,0 +1,190 @@
+"""
+Project: Air Partners
+
+Index of when every sensor was deployed, built from the sensor installation notes.
+"""
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+
+# sentinels for intervals that are open on one side
+_MIN_NS = np.iinfo(np.int64).min
+_MAX_NS = np.iinfo(np.int64).max
+# interval arrays of a sensor that is not in the install notes
+_NO_INTERVALS = (np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=bool))
+
+
+class DeploymentTimeline(object):
+    """
+    Per sensor, a sorted array of non-overlapping deployment intervals (installation, removal) and whether
+    the sensor was installed outdoors during each of them. All times are local (naive) times, like the
+    installation notes. Lookups are binary searches, so they take logarithmic time in the number of intervals.
+    """
+
+    def __init__(self, install_df):
+        """
+        Args:
+            install_df: (pandas.DataFrame) install notes as returned by DataImporter._get_install_data
+        """
+        when = pd.to_datetime(install_df['Date'] + ' ' + install_df['Time'], errors='coerce')
+        events = pd.DataFrame({
+            'sn': install_df['sn'],
+            'when': when,
+            'action': install_df['action'],
+            'outdoors': install_df['indoors_outdoors'] == 'Outdoors',
+        }).dropna(subset=['sn', 'when', 'action'])
+
+        # {sn: (starts, ends, outdoors)}, with sensors in the order they first appear in the notes
+        self.sensors = {}
+        for sn, sn_events in events.groupby('sn', sort=False):
+            self.sensors[sn] = self._build_intervals(sn_events.sort_values('when', kind='stable'))
+
+    def _build_intervals(self, events):
+        """
+        Turns the sorted installation and removal events of one sensor into deployment intervals. A removal
+        without an earlier installation is treated as deployed since the beginning of the notes, and an
+        installation without a later removal as still deployed.
+
+        Args:
+            events: (pandas.DataFrame) events of one sensor, sorted by time
+        Returns:
+            (tuple) numpy arrays of interval starts and ends in nanoseconds, and of the outdoors flag
+        """
+        starts, ends, outdoors = [], [], []
+        deployed = False
+        for row in events.itertuples():
+            if row.action == 'installation' and not deployed:
+                starts.append(row.when.value)
+                outdoors.append(row.outdoors)
+                deployed = True
+            elif row.action == 'removal' and deployed:
+                ends.append(row.when.value)
+                deployed = False
+            elif row.action == 'removal' and not starts:
+                starts.append(_MIN_NS)
+                ends.append(row.when.value)
+                outdoors.append(False)
+        if deployed:
+            ends.append(_MAX_NS)
+        return (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                np.array(outdoors, dtype=bool))
+
+    def _intervals(self, sn, outdoors_only=False):
+        """
+        Get the interval arrays of a sensor, optionally only the ones where it was installed outdoors.
+        """
+        starts, ends, outdoors = self.sensors.get(sn, _NO_INTERVALS)
+        if outdoors_only:
+            return starts[outdoors], ends[outdoors]
+        return starts, ends
+
+    @staticmethod
+    def _to_local_ns(timestamps):
+        """
+        Convert timestamps to local (naive) nanoseconds, the format the intervals are stored in.
+
+        Args:
+            timestamps: (pandas.Series or pandas.Timestamp) timezone aware or local timestamps
+        Returns:
+            int64 numpy array or int
+        """
+        if isinstance(timestamps, pd.Series):
+            if timestamps.dt.tz is not None:
+                timestamps = timestamps.dt.tz_convert('US/Eastern').dt.tz_localize(None)
+            return timestamps.to_numpy(dtype='datetime64[ns]').view(np.int64)
+        timestamps = pd.Timestamp(timestamps)
+        if timestamps.tzinfo is not None:
+            timestamps = timestamps.tz_convert('US/Eastern').tz_localize(None)
+        return timestamps.value
+
+    def intervals(self, sn):
+        """
+        Args:
+            sn: (str) serial number of the sensor
+        Returns:
+            (list) (installed, removed, outdoors) tuples, where installed/removed are None if unbounded
+        """
+        starts, ends, outdoors = self.sensors.get(sn, _NO_INTERVALS)
+        to_ts = lambda ns: None if ns in (_MIN_NS, _MAX_NS) else pd.Timestamp(ns)
+        return [(to_ts(s), to_ts(e), bool(o)) for s, e, o in zip(starts, ends, outdoors)]
+
+    def is_active(self, sn, t, outdoors_only=False):
+        """
+        Args:
+            sn: (str) serial number of the sensor
+            t: (datetime) time to check
+            outdoors_only: (bool) if True, only count deployments outdoors
+        Returns:
+            (bool) True if the sensor was deployed at time t
+        """
+        return bool(self.mask(sn, pd.Series([pd.Timestamp(t)]), outdoors_only)[0])
+
+    def mask(self, sn, timestamps, outdoors_only=False):
+        """
+        Finds which timestamps fall strictly inside a deployment interval of the sensor, with one binary search
+        for all timestamps.
+
+        Args:
+            sn: (str) serial number of the sensor
+            timestamps: (pandas.Series) timestamps of the sensor's data
+            outdoors_only: (bool) if True, only count deployments outdoors
+        Returns:
+            (numpy.ndarray) boolean array, True where the sensor was deployed
+        """
+        starts, ends = self._intervals(sn, outdoors_only)
+        if len(starts) == 0:
+            return np.zeros(len(timestamps), dtype=bool)
+        ts = self._to_local_ns(timestamps)
+        # index of the last interval that started strictly before each timestamp
+        idx = np.searchsorted(starts, ts, side='left') - 1
+        return (idx >= 0) & (ts < ends[np.maximum(idx, 0)])
+
+    def active_sensors(self, start, end, outdoors_only=True):
+        """
+        Args:
+            start: (datetime) beginning of the time range
+            end: (datetime) end of the time range (exclusive)
+            outdoors_only: (bool) if True, only count deployments outdoors
+        Returns:
+            (list) serial numbers of the sensors that were deployed at any time in [start, end)
+        """
+        start, end = self._to_local_ns(start), self._to_local_ns(end)
+        active = []
+        for sn in self.sensors:
+            starts, ends = self._intervals(sn, outdoors_only)
+            # intervals don't overlap, so the last one starting before the end of the range ends the latest
+            idx = np.searchsorted(starts, end, side='left') - 1
+            if idx >= 0 and ends[idx] > start:
+                active.append(sn)
+        return active
+
+
+def load_timeline(csv_path, get_install_data):
+    """
+    Load the deployment timeline from the cache next to the install notes, rebuilding it if the notes changed or
+    the cache can't be read.
+
+    :param csv_path: (str) path to the sensor install notes csv
+    :param get_install_data: (function) returns the install notes dataframe, only called if the cache is stale
+    :returns: DeploymentTimeline
+    """
+    with open(csv_path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    cache_path = os.path.splitext(csv_path)[0] + '_timeline.pckl'
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+            if cached.get('digest') == digest:
+                return cached['timeline']
+        except Exception as exp:
+            print(f"could not read the cached deployment timeline, rebuilding it: {exp}")
+
+    timeline = DeploymentTimeline(get_install_data())
+    # write to a temporary file first so that an interrupted or concurrent run never leaves a broken cache behind
+    with open(cache_path + '.tmp', 'wb') as f:
+        pickle.dump({'digest': digest, 'timeline': timeline}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+    return timeline
@@ -0,0 +1,81 @@
+"""
+Project: Air Partners
+
+Per-sensor aggregates shared by all visualizers, so the minute data of a sensor is resampled once per run instead
+of once per figure.
+"""
+
+from data_analysis.schema import normalize
+from visualizers.diurnal_profile import DiurnalProfile, PMS, TIME_LABELS, time_slots
+
+
+class SensorAggregates(object):
+    """
+    Aggregates of one sensor's data, all in local time:
+        data: normalized minute data (None if the aggregates were made without it, see summary)
+        ten_min: 10 minute means of the pollutants, with a boolean 'weekday' column and a 'time' column
+            holding the "HH:MM" time-of-day label of each slot
+        time_key: index (0 to 143) of the time-of-day slot of each row of ten_min
+        daily: daily means of the pollutants
+        diurnal: DiurnalProfile of the 10 minute means
+        last: time of the last reading, None if there is no data
+    """
+
+    def __init__(self, df):
+        """
+        Args:
+            df: (pandas.DataFrame) cleaned data of one sensor
+        """
+        self.data = normalize(df)
+        pms = [pm for pm in PMS if pm in self.data]
+        values = self.data[pms].astype('float64')
+
+        self.ten_min = values.resample('10T').mean()
+        index = self.ten_min.index
+        self.time_key = time_slots(index)
+        self.ten_min['weekday'] = index.weekday < 5
+        self.ten_min['time'] = TIME_LABELS[self.time_key]
+
+        self.daily = values.resample('1D').mean()
+        self.diurnal = DiurnalProfile(self.ten_min)
+        self.last = self.data.index[-1] if len(self.data) else None
+
+    @property
+    def weekday(self):
+        """
+        (numpy.ndarray) boolean mask of the rows of ten_min that fall on a weekday
+        """
+        return self.ten_min['weekday'].to_numpy()
+
+    def summary(self):
+        """
+        Returns:
+            (SensorAggregates) copy without the minute data, for figures that only need the aggregates
+        """
+        summary = object.__new__(SensorAggregates)
+        summary.__dict__.update(self.__dict__, data=None)
+        return summary
+
+
+def aggregates(data):
+    """
+    Args:
+        data: (pandas.DataFrame or SensorAggregates) cleaned data of one sensor, or its aggregates
+    Returns:
+        (SensorAggregates) aggregates of the sensor, only computed if data is a dataframe
+    """
+    if isinstance(data, SensorAggregates):
+        return data
+    return SensorAggregates(data)
+
+
+def minute_data(data):
+    """
+    Args:
+        data: (pandas.DataFrame or SensorAggregates) cleaned data of one sensor, or its aggregates
+    Returns:
+        (pandas.DataFrame) the sensor's normalized minute data
+    """
+    if isinstance(data, SensorAggregates):
+        return data.data
+    return normalize(data)
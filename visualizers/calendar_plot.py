@@ -12,6 +12,7 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
+from visualizers.aggregates import aggregates
 
 calendar.setfirstweekday(6) # Sunday is 1st day in US
 w_days = 'Sun Mon Tue Wed Thu Fri Sat'.split()
@@ -50,8 +51,8 @@ class CalendarPlot(object):
         self.low_thresh = label_dict[pm][3]
         # Create a list of lists for each week
         self.cal = calendar.monthcalendar(year, month)
-        # Save the PM data in the same format
-        self.pm_vals = [[0 for day in week] for week in self.cal]
+        # Save the PM data in the same format, 0 where there is no data
+        self.pm_vals = np.zeros((len(self.cal), 7))
         
     def _get_colors(self):    
         """
@@ -63,92 +64,80 @@ class CalendarPlot(object):
         smap = sns.color_palette('Spectral_r', self.scale)
         return smap
 
-    def _monthday_to_index(self, day):
+    def _day_cells(self, days):
         """
-        Gives index of the day in terms of where it is on the calendar 
-        grid.
+        Gives the position of days on the calendar grid.
 
         Args:
-            day - (int) a given day in the calendar month
+            days: (numpy.ndarray) days of the calendar month
         Returns:
-            None
+            (tuple) numpy arrays of the week (row) and weekday (column) of each day
         """
-        for week_n, week in enumerate(self.cal):
-            try:
-                i = week.index(day)
-                return week_n, i
-            except ValueError:
-                pass
-         # couldn't find the day
-        raise ValueError("There aren't {} days in the month".format(day))
+        # column of the 1st of the month; the days after it fill the grid row by row
+        offset = self.cal[0].index(1)
+        cells = offset + np.asarray(days) - 1
+        return cells // 7, cells % 7
 
-    def add_pm_vals(self, df):
+    def add_pm_vals(self, data):
         """
         Assign PM value for each day in the month based on air quality DataFrame
 
         Args:
-            df: (pandas.DataFrame) cleaned dataset of air quality over past month
+            data: (pandas.DataFrame or SensorAggregates) cleaned dataset of air quality over past month, or its
+                aggregates
         """
+        # daily means are computed once per sensor and shared by the calendars of all pollutants
+        agg = aggregates(data)
         # Check if the date at which data is generated is happening within designated month
         # and year; if it is, set end_date to most recent day; otherwise, set it to last day of month
-        recent = df.iloc[-1]['timestamp']
+        recent = agg.last
         if self.month==recent.month and self.year==recent.year:
             end_date = recent.day
         else:
             end_date = calendar.monthrange(self.year, self.month)[1]
         # Reformat data so only data from that month is plotted
-        df = df.drop(['geo','model','sn'],axis=1)
-        df = df.set_index('timestamp').resample('1D').mean()
-        start_date = end_date - df.shape[0]
-        # Doing days in reversed order, for the case that a sensor was 
-        # installed in middle of month
-        for day in reversed(range(start_date, end_date)):
-            week, w_day = self._monthday_to_index(day+1)
-            pm_val = df.iloc[day - (start_date)][self.pm]
-            if np.isnan(pm_val):
-                self.pm_vals[week][w_day] = 0
-            else:
-                self.pm_vals[week][w_day] = df.iloc[day - (start_date)][self.pm]
+        df = agg.daily
+        # the first hours of the month in UTC are the last day of the previous month in local time
+        df = df[(df.index.year == self.year) & (df.index.month == self.month) & (df.index.day <= end_date)]
+        # days without data are 0
+        week, w_day = self._day_cells(df.index.day)
+        self.pm_vals[week, w_day] = np.nan_to_num(df[self.pm].to_numpy(dtype=float), nan=0)
 
     def show(self):
         """
-        Create the calendar to be displayed
+        Create the calendar to be displayed. The whole month is drawn as one grid of colored cells on a single
+        axes, with a colormap made of the same palette the colorbar shows.
         """
-        # Create color spectrum
+        # Create color spectrum: days below 1 get the first color, 1 to 2 the second, etc. and days at or above
+        # the scale maximum the last color
         color_list = self._get_colors()
+        cmap = matplotlib.colors.ListedColormap(color_list)
+        cmap.set_over(color_list[-1])
+        # days without PM data (0) and cells outside the month are left white
+        cmap.set_bad('white')
+        bounds = matplotlib.colors.BoundaryNorm(np.arange(self.scale + 1), cmap.N)
+        cal = np.array(self.cal)
+        values = np.ma.masked_where((cal == 0) | (self.pm_vals == 0), self.pm_vals)
 
-        # Create grid of subplots, where each subplot is a day in the calendar
-        f, axs = plt.subplots(len(self.cal), 7, sharex=True, sharey=True)
-        for week, ax_row in enumerate(axs):
-            for week_day, ax in enumerate(ax_row):
-                ax.set_xticks([])
-                ax.set_yticks([])
-                # Create numbers for the days in the calendar where they belong
-                if self.cal[week][week_day] != 0:
-                    ax.text(.5, .5,
-                            str(self.cal[week][week_day]),
-                            fontsize=16,
-                            verticalalignment='center',
-                            horizontalalignment='center')
-                    # TODO: change this scale to make sense with PM 2.5 values
-                    pm_val = self.pm_vals[week][week_day]
-                    # if PM value is very high, color of day is last color on palette
-                    if pm_val >= self.scale:
-                        ax.set_facecolor(color_list[-1])
-                    # if PM value is zero, no PM data from that day, leave white
-                    elif pm_val == 0:
-                        ax.set_facecolor('white')
-                    # otherwise, color day appropriately based on scale
-                    else:
-                        ax.set_facecolor(color_list[int(self.pm_vals[week][week_day])])
+        f, ax = plt.subplots()
+        ax.pcolormesh(values, cmap=cmap, norm=bounds, edgecolors='black', linewidth=0.8)
+        ax.set_xlim(0, 7)
+        ax.set_ylim(len(self.cal), 0)
+        ax.set_yticks([])
+        # use the weekdays as titles of the columns
+        ax.xaxis.tick_top()
+        ax.set_xticks(np.arange(7) + 0.5)
+        ax.set_xticklabels(w_days, fontsize='large')
+        ax.tick_params(axis='x', length=0)
+        # Create numbers for the days in the calendar where they belong
+        days = np.arange(1, calendar.monthrange(self.year, self.month)[1] + 1)
+        week, w_day = self._day_cells(days)
+        for day, row, col in zip(days, week, w_day):
+            ax.text(col + .5, row + .5, str(day),
+                    fontsize=16,
+                    verticalalignment='center',
+                    horizontalalignment='center')
 
-        # use the titles of the first row as the weekdays
-        for n, day in enumerate(w_days):
-            axs[0][n].set_title(day)
-
-        # Place subplots in a close grid
-        f.subplots_adjust(hspace=0)
-        f.subplots_adjust(wspace=0)
         f.subplots_adjust(right=0.8)
         f.suptitle(self.label + ' ' + m_names[self.month-1] + ' ' + str(self.year) + '\n',
                    fontsize=16, fontweight='bold')
@@ -5,11 +5,12 @@ Project: Air Partners
 Class for creating diurnal (daily) plots that show air quality trends on any weekday and weekend.
 """
 
-import pandas as pd
 import numpy as np
 from datetime import datetime
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
+from visualizers.aggregates import SensorAggregates, aggregates, minute_data
+from visualizers.diurnal_profile import DiurnalProfile
 
 # Subscripts (for captions and labels)
 SUB = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")
@@ -25,53 +26,27 @@ class DiurnalPlot(object):
         """
         self.pm = pm
     
-    def convert_timestamps(self, df):
-        """
-        Convert all timestamp strings to datetime objects
-
-        :param df: (pd.DataFrame) dataframe containing sensor data
-        :returns: df with timestamps converted to datetime
-
-        Code copied from quantaq_pipeline.py, written by Hwei-Shin Harrimam
-        """
-        #timestamp is already in UTC
-        df = df.assign(timestamp=pd.to_datetime(df['timestamp']))
-        # timestamp contains "local" time (but expresses it in UTC, so 18:59 Eastern is expressed as 18:59 UTC)
-        # need to change the timezone without altering the hour of day.
-        # So, convert to datetime, remove automatically applied UTC timezone, and convert to US/Eastern time.
-        try:
-            dti = pd.to_datetime(df['timestamp']).dt.tz_localize(None).dt.tz_localize('US/Eastern')
-            df = df.assign(timestamp_local=dti)
-        except:
-            pass
-        #order by timestamp asc instead of desc
-        df = df.sort_values(by=['timestamp'])
-        return df
-
-    
-    def process_data(self, df, get_weekdays=True, resampling=True):
+    def process_data(self, data, get_weekdays=True, resampling=True):
         """
         Process dataframe for plotting.
 
         Args:
-            df: (pandas.DataFrame) cleaned dataset containing air quality data of the month
-            get_weekdays: (bool) if True, creates column in df to specify weekdays and weekends
-            resampling: (bool) if True, resamples dataset by every 10 minutes for cleaner graph
+            data: (pandas.DataFrame or SensorAggregates) cleaned dataset containing air quality data of the month,
+                or its aggregates
+            get_weekdays: (bool) if True, keeps boolean column 'weekday' to specify weekdays and weekends
+            resampling: (bool) if True, uses the dataset resampled by every 10 minutes for cleaner graph
+        Returns:
+            (pandas.DataFrame) data with a 'time' column holding the time of day of each row
         """
-        # localize timestamps
-        df = self.convert_timestamps(df)
-        # if get_weekdays, add boolean column 'weekday' where 1 represents weekday, 0 represents weekend
-        if get_weekdays:
-            df['weekday'] = [df.iloc[row]['timestamp'].weekday() < 5 for row in range(df.shape[0])]
-        
-        # if resampling, resample dataframe for every 10 minutes
+        # the 10 minute resample, weekday flags and time of day are computed once per sensor
         if resampling:
-            df = df.drop(['geo','model','sn'],axis=1)
-            df = df.set_index('timestamp').resample('10T').mean()
-        
-        # Create time column for indexing
-        df['time'] = df.index.map(lambda x: x.strftime("%H:%M"))       
+            df = aggregates(data).ten_min
+        else:
+            df = minute_data(data)
+            df = df.assign(weekday=df.index.weekday < 5, time=df.index.strftime("%H:%M"))
 
+        if not get_weekdays:
+            df = df.drop(columns='weekday')
         return df
 
     def _military_to_regular(self, time):
@@ -110,12 +85,28 @@ class DiurnalPlot(object):
         return time
 
 
-    def show(self, df, weekday=True):
+    def profile(self, data):
+        """
+        Get the diurnal statistics of a sensor.
+
+        Args:
+            data: (DiurnalProfile, SensorAggregates or pandas.DataFrame) statistics, aggregates, or data as returned
+                by process_data
+        Returns:
+            (DiurnalProfile)
+        """
+        if isinstance(data, DiurnalProfile):
+            return data
+        if isinstance(data, SensorAggregates):
+            return data.diurnal
+        return DiurnalProfile(data)
+
+    def show(self, data, weekday=True):
         """
         Create diurnal plot figure that can be shown on report.
 
         Args:
-            df: (pandas.DataFrame) cleaned dataset containing air quality data of the month
+            data: (DiurnalProfile, SensorAggregates or pandas.DataFrame) statistics of the sensor, see profile
             weekday: (bool) if True, create diurnal plot for weekdays; if False, for weekends
         """
         label_dict = {
@@ -123,25 +114,19 @@ class DiurnalPlot(object):
             'pm25': 'PM2.5'.translate(SUB),
             'pm10': 'PM10'.translate(SUB)
         }
-        # If weekday, filter out rows that are weekends, and vice versa
-        if 'weekday' in df:
-            if weekday:
-                df = df[df['weekday']==1]
-            else:
-                df = df[df['weekday']==0]
-        # Groupby time and calculate metrics
-        df = df.groupby('time')[self.pm]
-        df_mean = df.mean()
-        df_median = df.median()
-        df_q1 = df.quantile(q=0.25)
-        df_q3 = df.quantile(q=0.75)
-        df_05 = df.quantile(q=0.05)
-        df_95 = df.quantile(q=0.95)
+        # mean and percentiles of each time of day, for weekdays or weekends
+        stats = self.profile(data).stats(self.pm, weekday)
+        df_mean = stats['mean']
+        df_median = stats['p50']
+        df_q1 = stats['p25']
+        df_q3 = stats['p75']
+        df_05 = stats['p5']
+        df_95 = stats['p95']
         #print(f'\tMean: {df_mean}\n\tMedian: {df_median}\n\tQ1: {df_q1}\n\tQ3: {df_q3}\n\t05: {df_05}\n\t95: {df_95}')
         # Plot results (note that df_mean.index returns time; can be replaced by any other metric to get index)
         fig,axes=plt.subplots(1,1,figsize=(8,5))
         # if there is not enough data for analysis, display warning on report
-        if len(df_mean)==0:
+        if df_mean.isna().all():
             error = plt.imread('_images/error-404.png')
             axes.set_xticks([]); axes.set_yticks([])
             axes.imshow(error)
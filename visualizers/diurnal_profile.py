@@ -0,0 +1,80 @@
+"""
+Project: Air Partners
+
+Diurnal (time of day) statistics of a sensor, for weekdays and weekends, computed for all pollutants at once.
+"""
+
+import warnings
+import numpy as np
+import pandas as pd
+
+# pollutants that are profiled
+PMS = ['pm1', 'pm25', 'pm10']
+# number of 10 minute slots in a day
+SLOTS = 144
+# "HH:MM" label of each 10 minute slot of the day
+TIME_LABELS = np.array(['{0:02d}:{1:02d}'.format(h, m) for h in range(24) for m in range(0, 60, 10)])
+# percentiles drawn by the diurnal plots
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def time_slots(index):
+    """
+    Args:
+        index: (pandas.DatetimeIndex) local times
+    Returns:
+        (numpy.ndarray) index (0 to 143) of the 10 minute slot of the day of each time
+    """
+    return index.hour.to_numpy() * 6 + index.minute.to_numpy() // 10
+
+
+class DiurnalProfile(object):
+    """
+    Mean and percentiles of every pollutant for each 10 minute slot of the day, separately for weekdays and
+    weekends. The data is laid out as a (day x 144 slots x pollutant) array, so the percentiles of both day types
+    and all pollutants come out of a single nanpercentile call.
+    """
+
+    def __init__(self, ten_min):
+        """
+        Args:
+            ten_min: (pandas.DataFrame) 10 minute means of the pollutants, indexed by local time
+        """
+        self.pms = [pm for pm in PMS if pm in ten_min]
+        index = ten_min.index
+        day_codes, days = pd.factorize(index.normalize())
+
+        # (day, slot, pollutant); slots without data stay NaN
+        grid = np.full((len(days), SLOTS, len(self.pms)), np.nan)
+        grid[day_codes, time_slots(index)] = ten_min[self.pms].to_numpy(dtype='float64')
+
+        # (weekday/weekend, day, slot, pollutant), with the days of the other type masked out
+        is_weekday = np.asarray(days.weekday < 5)
+        day_types = np.stack([is_weekday, ~is_weekday])[:, :, None, None]
+        grouped = np.where(day_types, grid[None], np.nan)
+
+        if len(days):
+            # slots without any data warn and are NaN
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self.mean = np.nanmean(grouped, axis=1)
+                self.percentiles = np.nanpercentile(grouped, PERCENTILES, axis=1)
+        else:
+            self.mean = np.full((2, SLOTS, len(self.pms)), np.nan)
+            self.percentiles = np.full((len(PERCENTILES), 2, SLOTS, len(self.pms)), np.nan)
+
+    def stats(self, pm, weekday=True):
+        """
+        Args:
+            pm: (str) type of PM
+            weekday: (bool) if True, statistics of weekdays; if False, of weekends
+        Returns:
+            (pandas.DataFrame) indexed by the "HH:MM" slot labels, with a 'mean' column and a 'p<percentile>' column
+            for each of PERCENTILES
+        """
+        day_type = 0 if weekday else 1
+        j = self.pms.index(pm)
+        columns = {'mean': self.mean[day_type, :, j]}
+        for i, p in enumerate(PERCENTILES):
+            columns['p{}'.format(p)] = self.percentiles[i, day_type, :, j]
+        return pd.DataFrame(columns, index=pd.Index(TIME_LABELS, name='time'))
@@ -9,29 +9,83 @@ on a minute (sampling) basis.
 from IPython.core.pylabtools import figsize
 from matplotlib.offsetbox import AnchoredText
 import matplotlib.pyplot as plt
+import numpy as np
+from visualizers.aggregates import minute_data
+
+# number of buckets each panel is decimated to. The panels are about 4000 pixels wide in the saved report (17 inches
+# at 300 dpi), so a bucket is narrower than a pixel. Every bucket keeps its minimum and maximum, so a panel draws
+# about twice this many points instead of one per minute
+DECIMATION_BUCKETS = 4500
+
+
+def minmax_indices(values, buckets, breaks=None):
+    """
+    Pick the points of a series to draw: the minimum and maximum of each of a number of equally sized buckets,
+    the first and last point, and both ends of every run of missing values and of every run of breaks. Peaks are
+    kept, and so are threshold crossings: a bucket where the series crosses a threshold has its minimum below and
+    its maximum above it. Only the first and last run end of each bucket is kept, so however many gaps the series
+    has, at most 6 * buckets + 2 points are drawn.
+
+    Args:
+        values: (numpy.ndarray) series to decimate
+        buckets: (int) number of buckets
+        breaks: (numpy.ndarray) boolean mask, e.g. of inactive readings, whose runs must keep both of their ends
+    Returns:
+        (numpy.ndarray) sorted indices of the points to draw
+    """
+    n = len(values)
+    if n <= 2 * buckets:
+        return np.arange(n)
+    size = -(-n // buckets)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+    missing = np.isnan(padded)
+    starts = np.arange(buckets) * size
+    lows = starts + np.argmin(np.where(missing, np.inf, padded), axis=1)
+    highs = starts + np.argmax(np.where(missing, -np.inf, padded), axis=1)
+    # missing values and inactive readings leave a gap in the plot, keep the points on both sides of where a run of
+    # them starts and ends so the gap isn't bridged. A bucket is narrower than a pixel, so only the first and last
+    # change of each bucket are needed, which keeps an isolated gap whole and caps the points many gaps add
+    changes = np.diff(np.isnan(values))
+    if breaks is not None:
+        changes |= np.diff(np.asarray(breaks, dtype=bool))
+    changes = np.flatnonzero(changes)
+    change_buckets = changes // size
+    first = np.unique(change_buckets, return_index=True)[1]
+    last = len(changes) - 1 - np.unique(change_buckets[::-1], return_index=True)[1]
+    edges = changes[np.concatenate([first, last])]
+    indices = np.unique(np.concatenate([lows, highs, edges, edges + 1, [0, n - 1]]).astype(np.int64))
+    return indices[indices < n]
+
 
 class Timeplot(object):
     """
-    
+
     """
 
-    def __init__(self, df):
-        self.df = df
-    
+    def __init__(self, df, decimate=True):
+        """
+        Args:
+            df: (pandas.DataFrame or SensorAggregates) cleaned data of one sensor, or its aggregates
+            decimate: (bool) if True, panels only draw the points that are visible at the saved resolution
+        """
+        # normalized minute data, from a dataframe or a sensor's aggregates
+        self.df = minute_data(df)
+        self.decimate = decimate
+
     def detect_inactive_sensor(self, timedelta_to_consider_inactive_in_minutes):
-        inactive = [0]
-        for i in range(1, len(self.df)):
-            timedelta = (self.df.timestamp.iloc[i] - self.df.timestamp.iloc[i-1]).total_seconds()/60
-            if timedelta >= timedelta_to_consider_inactive_in_minutes:
-                inactive.append(1)
-                inactive[i-1] = 1
-            else:
-                inactive.append(0)
-        self.df['inactive'] = inactive
+        # a reading is inactive if the reading before or after it is at least the given number of minutes away
+        times = self.df.index.values
+        gaps = np.diff(times) >= np.timedelta64(timedelta_to_consider_inactive_in_minutes, 'm')
+        inactive = np.zeros(len(times), dtype=int)
+        inactive[1:] |= gaps
+        inactive[:-1] |= gaps
+        self.df = self.df.assign(inactive=inactive)
 
     def thresholds_subplots(self, plot_number, threshold_lower, threshold_upper, fig_axs):
-        # time variable
-        ts = self.df.timestamp
+        # time variable, as local wall-clock time so the axis is labeled in local time
+        ts = self.df.index.tz_localize(None)
         # subscripts for labels
         SUB = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")
         # defining subplot numbers
@@ -47,12 +101,20 @@ class Timeplot(object):
             pm = self.df.pm10
             ylabel = 'PM10'.translate(SUB)
             # ylim = (0, 200)
-        fig_axs[plot_number].fill_between(ts, pm, 0, where=(self.df.inactive == 0), facecolor="limegreen", interpolate=True, alpha=1,label='Low: < {}'.format(threshold_lower))
-        fig_axs[plot_number].fill_between(ts, pm, threshold_lower, where=(self.df.inactive == 0) & (pm >= threshold_lower), facecolor="gold", interpolate=False, alpha=1,label='Medium')
-        fig_axs[plot_number].fill_between(ts, pm, threshold_upper, where=(pm >= threshold_upper), facecolor="orangered", interpolate=False, alpha=1,label='High: > {}'.format(threshold_upper))
+        # only draw the points that can be seen; both ends of every run of inactive readings are kept so gaps look
+        # the same
+        values = pm.to_numpy(dtype=float)
+        inactive = self.df.inactive.to_numpy()
+        if self.decimate:
+            shown = minmax_indices(values, DECIMATION_BUCKETS, breaks=inactive)
+            ts, values, inactive = ts[shown], values[shown], inactive[shown]
+        with np.errstate(invalid='ignore'):
+            fig_axs[plot_number].fill_between(ts, values, 0, where=(inactive == 0), facecolor="limegreen", interpolate=True, alpha=1,label='Low: < {}'.format(threshold_lower))
+            fig_axs[plot_number].fill_between(ts, values, threshold_lower, where=(inactive == 0) & (values >= threshold_lower), facecolor="gold", interpolate=False, alpha=1,label='Medium')
+            fig_axs[plot_number].fill_between(ts, values, threshold_upper, where=(values >= threshold_upper), facecolor="orangered", interpolate=False, alpha=1,label='High: > {}'.format(threshold_upper))
         fig_axs[plot_number].set_ylabel('{}\n[μg/m³]'.format(ylabel), fontsize=18)
         #fig_axs[plot_number].set_ylim(ylim)
-        
+
         handles, labels = fig_axs[plot_number].get_legend_handles_labels()
         fig_axs[plot_number].legend(handles[::-1], labels[::-1],bbox_to_anchor=(1.0,0.5),loc = 'center left')
 
@@ -82,4 +144,5 @@ class Timeplot(object):
 
         # Hide x labels and tick labels for all but bottom plot.
         for ax in axs:
-            ax.label_outer()
\ No newline at end of file
+            ax.label_outer()
+